@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import os, os.path
+import pickle
+
+# append-only files of pickled records, used by the fingerprint store
+# and the build journal so interrupted runs keep what they wrote
+
+def file_key(path):
+    # (size, mtime in ns) identifies the version of a file
+    st = os.stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1e9))
+    return (st.st_size, mtime_ns)
+
+def read_records(path):
+    records = []
+    damaged = False
+    if os.path.exists(path):
+        good = 0
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except Exception:
+                    break
+                good = f.tell()
+        # partial record from an interrupted run
+        if good != os.path.getsize(path):
+            print '! %s truncated, dropping partial record' % path
+            damaged = True
+    return (records, damaged)
+
+def write_records(path, records):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        for record in records:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+def append_record(log, record):
+    pickle.dump(record, log, pickle.HIGHEST_PROTOCOL)
+    log.flush()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+import numpy as np
+from PIL import Image
+
+LD_WIDTH = 600
+HD_WIDTH = 1920
+# -normalize clips 2% of pixels to black and 1% to white
+NORMALIZE_BLACK = 2.0
+NORMALIZE_WHITE = 1.0
+
+def scaled_size(size, width):
+    (w, h) = size
+    return (width, max(1, int(round(h * float(width) / w))))
+
+def normalize(px):
+    # one stretch for all channels, taken from the pixel intensity
+    intensity = np.dot(px[:, :, 0:3], [0.299, 0.587, 0.114])
+    (black, white) = np.percentile(intensity, [NORMALIZE_BLACK, 100.0 - NORMALIZE_WHITE])
+    if white <= black:
+        return px
+    out = (px.astype(np.float32) - black) * (255.0 / (white - black))
+    return np.clip(np.rint(out), 0, 255).astype(np.uint8)
+
+def derive_base_images(src, ld, hd, hdn):
+    # decode once, at the smallest JPEG scale still wider than hd
+    img = Image.open(src)
+    size = img.size
+    img.draft('RGB', scaled_size(size, HD_WIDTH))
+    img = img.convert('RGB')
+
+    # convert -scale 600
+    img.resize(scaled_size(size, LD_WIDTH), Image.BOX).save(ld)
+    # convert -adaptive-resize 1920
+    hd_img = img.resize(scaled_size(size, HD_WIDTH), Image.LANCZOS)
+    hd_img.save(hd)
+    # convert -normalize -adaptive-resize 1920, stretching the resized
+    # image rather than the original
+    Image.fromarray(normalize(np.asarray(hd_img))).save(hdn)
+    return True
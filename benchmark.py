@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+import argparse
+import datetime
+import json
+import math
+import os, os.path
+import shutil
+import subprocess
+import sys
+import time
+
+import pickle
+
+import numpy as np
+from PIL import Image
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# module settings applied to prepare.py for each engine, RENDER_ENGINE
+# goes to render-frames.py as -e
+ENGINES = {
+    'numpy': {},
+    'subprocess': {
+        'BASE_ENGINE': 'convert',
+        'AVG_ENGINE': 'avgimg',
+        'FP_ENGINE': 'convert',
+        'METRIC_ENGINE': 'compare',
+        'DERIV_ENGINE': 'convert',
+        'RENDER_ENGINE': 'avgimg'
+    }
+}
+RENDER_SETTINGS = ['RENDER_ENGINE']
+
+STAGES = ['prepare', 'plot-measures', 'map-energy', 'pick-frames', 'render-frames']
+
+def frame_name(dt):
+    # 14 digit form understood by find_files/fn_to_date
+    return "%04d%02d%02d%02d%02d%02d.jpg" % (
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+
+def daylight(dt):
+    # 0 at night rising to 1 at midday
+    hour = dt.hour + dt.minute / 60.0
+    return max(0.0, math.sin(math.pi * (hour - 6.0) / 12.0)) * 0.9 + 0.1
+
+def make_scene(rng, width, height):
+    scene = np.zeros((height, width, 3))
+    scene[:, :] = rng.uniform(0.3, 0.7, 3)
+    # sky above the horizon
+    horizon = height // 3
+    scene[:horizon, :] = [0.55, 0.7, 0.9]
+    return scene
+
+def add_event(rng, scene):
+    # a new block appears and stays, e.g. a wall going up
+    (height, width) = scene.shape[0:2]
+    w = rng.randint(width // 10, width // 3)
+    h = rng.randint(height // 10, height // 2)
+    x = rng.randint(0, width - w)
+    y = rng.randint(height // 3, height - h)
+    scene[y:y + h, x:x + w] = rng.uniform(0.0, 1.0, 3)
+
+# prepare shifts frames back an hour, so starting at 01:00 keeps the
+# first day whole rather than leaving a night-only stub before it
+def generate_archive(path, days, width, height, interval, events, seed,
+        start=datetime.datetime(2014, 5, 1, 1)):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for fn in os.listdir(path):
+        if fn.endswith('.jpg'):
+            os.remove(os.path.join(path, fn))
+    rng = np.random.RandomState(seed)
+    scene = make_scene(rng, width, height)
+    event_days = sorted(rng.choice(days, min(events, days), replace=False))
+    count = 0
+    for day in range(days):
+        if day in event_days:
+            add_event(rng, scene)
+        dt = start + datetime.timedelta(days=day)
+        end = dt + datetime.timedelta(days=1)
+        while dt < end:
+            noise = rng.normal(0.0, 0.02, scene.shape)
+            px = np.clip((scene * daylight(dt) + noise) * 255.0, 0, 255)
+            Image.fromarray(px.astype(np.uint8)).save(
+                os.path.join(path, frame_name(dt)), quality=90)
+            dt += datetime.timedelta(minutes=interval)
+            count += 1
+    print 'generated', count, 'frames,', len(event_days), 'events'
+    return count
+
+def script(name):
+    return os.path.join(SCRIPT_DIR, name + '.py')
+
+def prepare_cmd(engine, src, data):
+    settings = ''.join(['prepare.%s = %r; ' % (k, v) for (k, v) in ENGINES[engine].items()
+        if k not in RENDER_SETTINGS])
+    code = 'import sys; sys.path.insert(0, %r); import prepare; %sprepare.main(%r)' % (
+        SCRIPT_DIR, settings, [src, data])
+    return [sys.executable, '-c', code]
+
+def stage_cmds(engine, work, src, frames, measures):
+    data = os.path.join(work, 'data-' + engine)
+    out = os.path.join(work, 'out-' + engine)
+    return {
+        'prepare': (prepare_cmd(engine, src, data), None),
+        'plot-measures': ([sys.executable, script('plot-measures'),
+            os.path.join(data, 'measure_store'), os.path.join(out, 'plot.pdf'),
+            os.path.join(out, 'energy')], None),
+        'map-energy': ([sys.executable, script('map-energy'),
+            os.path.join(out, 'energy'), str(frames)] + measures,
+            os.path.join(out, 'frames')),
+        'pick-frames': ([sys.executable, script('pick-frames'),
+            data, os.path.join(out, 'frames'), os.path.join(out, 'picks')], None),
+        'render-frames': ([sys.executable, script('render-frames'),
+            '-e', ENGINES[engine].get('RENDER_ENGINE', 'numpy'), data, os.path.join(out, 'picks'), os.path.join(out, 'render')], None)
+    }
+
+def run_stage(name, cmd, stdout_path, log):
+    print 'stage', name
+    start = time.time()
+    if stdout_path:
+        with open(stdout_path, 'w') as out:
+            returncode = subprocess.call(cmd, stdout=out, stderr=log)
+    else:
+        returncode = subprocess.call(cmd, stdout=log, stderr=log)
+    seconds = time.time() - start
+    print '  %.2fs (exit %d)' % (seconds, returncode)
+    return { 'stage': name, 'seconds': seconds, 'returncode': returncode }
+
+def check_energy(work, engine):
+    # map-energy falls back to uniform counts when energies are NaN, which
+    # would leave the later stages timing made-up picks
+    with open(os.path.join(work, 'out-' + engine, 'energy'), 'rb') as f:
+        data = pickle.load(f)
+    energy = np.asarray(data['energy'])
+    if not np.all(np.isfinite(energy)):
+        return '%d of %d energies are not finite' % (
+            np.sum(~np.isfinite(energy)), energy.size)
+    return None
+
+# checks on a stage's outputs, returning an error or None
+CHECKS = {
+    'plot-measures': check_energy
+}
+
+def main(args):
+    parser = argparse.ArgumentParser(description='time the pipeline on a synthetic archive')
+    parser.add_argument('work', help='directory for the archive and outputs')
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--interval', type=int, default=30, help='minutes between frames')
+    parser.add_argument('--events', type=int, default=3, help='scene changes')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--frames', type=int, default=0, help='output frames (default 12 per day)')
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES.keys()))
+    parser.add_argument('--stage', action='append', choices=STAGES)
+    parser.add_argument('--measure', action='append')
+    parser.add_argument('--results', default=None, help='json results file')
+    parser.add_argument('--keep', action='store_true',
+        help='reuse the data and frames of an earlier run (warm timing)')
+    opts = parser.parse_args(args)
+
+    engines = opts.engine or ['numpy']
+    stages = opts.stage or STAGES
+    measures = opts.measure or ['geoavg-gray-edges:energy4', 'raw-geoavg:energy4']
+    frames = opts.frames or (opts.days * 12)
+    results_path = opts.results or os.path.join(opts.work, 'results.json')
+
+    # the archive is reused so engines are compared on the same data
+    src = os.path.join(opts.work, 'src')
+    config = {
+        'days': opts.days, 'width': opts.width, 'height': opts.height,
+        'interval': opts.interval, 'events': opts.events, 'seed': opts.seed
+    }
+    config_path = os.path.join(src, 'config.json')
+    if not (os.path.exists(config_path) and json.load(open(config_path)) == config):
+        generate_archive(src, opts.days, opts.width, opts.height,
+            opts.interval, opts.events, opts.seed)
+        with open(config_path, 'w') as f:
+            json.dump(config, f)
+
+    results = { 'config': config, 'frames': frames, 'keep': opts.keep, 'runs': [] }
+    for engine in engines:
+        out = os.path.join(opts.work, 'out-' + engine)
+        if not opts.keep:
+            # prepare and render-frames skip what earlier runs left, the
+            # other stages write their outputs whole
+            if 'prepare' in stages:
+                shutil.rmtree(os.path.join(opts.work, 'data-' + engine), ignore_errors=True)
+            if 'render-frames' in stages:
+                shutil.rmtree(os.path.join(out, 'render'), ignore_errors=True)
+        if not os.path.exists(os.path.join(out, 'render')):
+            os.makedirs(os.path.join(out, 'render'))
+        cmds = stage_cmds(engine, opts.work, src, frames, measures)
+        run = { 'engine': engine, 'stages': [], 'ok': True }
+        with open(os.path.join(out, 'log'), 'w') as log:
+            for name in stages:
+                (cmd, stdout_path) = cmds[name]
+                stage = run_stage(name, cmd, stdout_path, log)
+                run['stages'].append(stage)
+                if stage['returncode'] == 0 and name in CHECKS:
+                    error = CHECKS[name](opts.work, engine)
+                    if error:
+                        print '  failed:', error
+                        stage['error'] = error
+                if stage['returncode'] != 0 or 'error' in stage:
+                    run['ok'] = False
+                    break
+        run['total'] = sum([s['seconds'] for s in run['stages']])
+        results['runs'].append(run)
+
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print 'results written to', results_path
+    if not all([r['ok'] for r in results['runs']]):
+        print 'benchmark failed'
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
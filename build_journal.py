@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import hashlib
+import os, os.path
+
+from append_log import append_record, file_key, read_records, write_records
+
+JOURNAL_NAME = 'build_journal'
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def recipe(cmd):
+    # how an output is made; python calls are recorded by name
+    if isinstance(cmd, tuple):
+        (func, args) = cmd
+        return (func.__module__ + '.' + func.__name__, args)
+    return tuple(cmd)
+
+# records the command and input/output states of every output built,
+# so a task only reruns when its recipe or inputs change
+class BuildJournal:
+    def __init__(self):
+        self.path = None
+        self.log = None
+        self.entries = {}
+        self.records = 0
+        self.states = {}
+        self.skewed = False
+        # tasks and outputs built since the journal was opened
+        self.rebuilt = set()
+
+    def open(self, root):
+        self.close()
+        self.path = os.path.join(root, JOURNAL_NAME)
+        self.entries = {}
+        self.states = {}
+        self.rebuilt = set()
+        (records, damaged) = read_records(self.path)
+        for (fn, entry) in records:
+            self.entries[fn] = entry
+        self.records = len(records)
+        if damaged or self.records > 2 * len(self.entries):
+            self.compact()
+        self.log = open(self.path, 'ab')
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+            if self.records > 2 * len(self.entries):
+                self.compact()
+
+    def checkpoint(self):
+        # drop cached file states and rewrite the log once it is mostly
+        # superseded records, for a journal held open a long time
+        self.states = {}
+        self.rebuilt = set()
+        if self.log and self.records > 2 * len(self.entries):
+            self.log.close()
+            self.compact()
+            self.log = open(self.path, 'ab')
+
+    def compact(self):
+        write_records(self.path, self.entries.items())
+        self.records = len(self.entries)
+
+    def file_state(self, path):
+        if not os.path.isfile(path):
+            return None
+        key = file_key(path)
+        state = self.states.get(path)
+        if state is None or state[0:2] != key:
+            state = key + (file_hash(path),)
+            self.states[path] = state
+        return state
+
+    def dep_state(self, dep):
+        if os.path.isfile(dep):
+            return self.file_state(dep)
+        elif dep in self.entries:
+            # a queued task without a file of its own
+            return ('task',) + tuple([s for (o, s) in self.entries[dep]['outputs']])
+        return None
+
+    def same(self, path, recorded):
+        if recorded is None:
+            return False
+        if recorded[0] == 'task':
+            return self.dep_state(path) == recorded
+        if not os.path.isfile(path):
+            return False
+        key = file_key(path)
+        if key[0] != recorded[0]:
+            return False
+        elif key[1] == recorded[1]:
+            return True
+        # mtime moved (copy or clock skew), compare contents
+        if self.file_state(path)[2] == recorded[2]:
+            self.skewed = True
+            return True
+        return False
+
+    def valid(self, fn, cmd, deps, outputs):
+        entry = self.entries.get(fn)
+        if entry is None:
+            return self.adopt(fn, cmd, deps, outputs)
+        if entry['cmd'] != recipe(cmd):
+            return False
+        if [d for (d, s) in entry['deps']] != list(deps):
+            return False
+        self.skewed = False
+        for (dep, state) in entry['deps']:
+            if not self.same(dep, state):
+                return False
+        for (out, state) in entry['outputs']:
+            if not self.same(out, state):
+                return False
+        # save the new mtimes so the contents are not hashed again
+        if self.skewed:
+            self.store(fn, cmd, deps, outputs)
+        return True
+
+    def adopt(self, fn, cmd, deps, outputs):
+        # outputs from before the journal existed are trusted if they are
+        # all strictly newer than the inputs, none of which was just rebuilt
+        newest = 0
+        for dep in deps:
+            if dep in self.rebuilt:
+                return False
+            if os.path.isfile(dep):
+                newest = max(newest, file_key(dep)[1])
+            elif dep not in self.entries:
+                return False
+        for out in outputs:
+            if (not os.path.isfile(out)) or file_key(out)[1] <= newest:
+                return False
+        self.store(fn, cmd, deps, outputs)
+        return True
+
+    def record(self, fn, cmd, deps, outputs):
+        # a task that has just been built
+        self.rebuilt.add(fn)
+        self.rebuilt.update(outputs)
+        self.store(fn, cmd, deps, outputs)
+
+    def store(self, fn, cmd, deps, outputs):
+        for out in outputs:
+            if out in self.states:
+                del self.states[out]
+        entry = {
+            'cmd': recipe(cmd),
+            'deps': [(dep, self.dep_state(dep)) for dep in deps],
+            'outputs': [(out, self.file_state(out)) for out in outputs]
+        }
+        self.entries[fn] = entry
+        if self.log:
+            append_record(self.log, (fn, entry))
+            self.records += 1
@@ -1,102 +1,389 @@
 #!/usr/bin/env python
 
+import collections
 import os
 import multiprocessing
+import multiprocessing.queues
+import resource
 import subprocess
+import threading
 import time
 
+from build_journal import BuildJournal
+from task_trace import TaskTrace
+
+TMP_PREFIX = '.tmp-'
+# share of physical memory commands may use by default
+MEMORY_FRACTION = 0.75
+# how far past a command that does not fit to look for one that does
+SCAN_LIMIT = 64
+DEFAULT_COST = (1, 0)
+# how often a pool task that has not finished checks its worker is alive
+POLL_SECONDS = 1.0
+
+def physical_memory_mb():
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')) / (1 << 20)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def default_memory_mb():
+    mem = physical_memory_mb()
+    if mem:
+        return int(mem * MEMORY_FRACTION)
+    return None
+
+# set in each pool worker, where tasks report the pid they run in
+_started = None
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+def _call(fn, func, args):
+    if _started is not None:
+        _started.put((fn, os.getpid()))
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        func(*args)
+        returncode = 0
+    except Exception as e:
+        print '!', func.__name__, e
+        returncode = 1
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    # peak rss is for the worker process as a whole
+    usage = (after.ru_utime - before.ru_utime, after.ru_stime - before.ru_stime, after.ru_maxrss)
+    return (returncode, usage)
+
+# a command run as a child process, waited for on its own thread
+class ProcessTask:
+    def __init__(self, fn, cmd, notify):
+        self.fn = fn
+        self.cmd = cmd
+        self.notify = notify
+        self.returncode = None
+        self.usage = (0.0, 0.0, 0)
+        self.start = time.time()
+        self.proc = subprocess.Popen(cmd)
+        waiter = threading.Thread(target=self.wait)
+        waiter.daemon = True
+        waiter.start()
+
+    def wait(self):
+        (pid, status, ru) = os.wait4(self.proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        self.proc.returncode = self.returncode
+        self.usage = (ru.ru_utime, ru.ru_stime, ru.ru_maxrss)
+        self.end = time.time()
+        self.notify(self)
+
+# which worker process each started pool task runs in; a task whose worker
+# has gone (killed for memory, say) never gets a result
+class WorkerPids:
+    def __init__(self):
+        # written straight to the pipe, a worker may be killed just after
+        self.queue = multiprocessing.queues.SimpleQueue()
+        self.pids = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        # pids of tasks from earlier runs, whose names may be used again
+        with self.lock:
+            while not self.queue.empty():
+                self.queue.get()
+            self.pids = {}
+
+    def lost(self, fn):
+        with self.lock:
+            while not self.queue.empty():
+                (started, pid) = self.queue.get()
+                self.pids[started] = pid
+            pid = self.pids.get(fn)
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            # the pool has already reaped it
+            return True
+        return False
+
+# a python function run in the worker pool, waited for on its own thread
+class PoolTask:
+    def __init__(self, fn, cmd, notify, pool, workers):
+        self.fn = fn
+        self.cmd = cmd
+        self.notify = notify
+        self.workers = workers
+        self.returncode = None
+        self.usage = (0.0, 0.0, 0)
+        self.start = time.time()
+        (func, args) = cmd
+        self.result = pool.apply_async(_call, (fn, func, args))
+        waiter = threading.Thread(target=self.wait)
+        waiter.daemon = True
+        waiter.start()
+
+    def wait(self):
+        while not self.result.ready():
+            self.result.wait(POLL_SECONDS)
+            if not self.result.ready() and self.workers.lost(self.fn):
+                print '!', self.fn, 'worker process died'
+                self.returncode = 1
+                break
+        else:
+            try:
+                (self.returncode, self.usage) = self.result.get()
+            except Exception as e:
+                # arguments or result that cannot be pickled
+                print '!', self.fn, e
+                self.returncode = 1
+        self.end = time.time()
+        self.notify(self)
+
 class CommandQueue:
-    def __init__(self, n_threads=multiprocessing.cpu_count()):
+    def __init__(self, n_threads=multiprocessing.cpu_count(), memory_mb=default_memory_mb()):
+        # budgets: cpu slots and memory (None for no limit)
         self.n_threads = n_threads
+        self.memory_mb = memory_mb
+        self.used_cpu = 0
+        self.used_memory = 0
+        self.costs = {}
         self.ready = {}
-        self.queue = {}
+        self.queue = collections.OrderedDict()
+        self.pool = None
+        self.workers = None
+        # dependency graph of the queued commands, built by schedule()
+        self.pending = {}
+        self.dependents = {}
+        self.runnable = collections.deque()
+        # finished tasks, with a byte written to the pipe for each
+        self.finished = collections.deque()
+        (self.wake_r, self.wake_w) = os.pipe()
+        # files each command writes, if not just fn
+        self.outputs = {}
+        self.journal = None
+        self.added = {}
+        self.trace = TaskTrace()
 
-    def add(self, fn, deps, cmd):
+    def open_journal(self, path):
+        # only skip commands whose recorded recipe and inputs still match
+        self.journal = BuildJournal()
+        self.journal.open(path)
+
+    def close_journal(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def reset(self):
+        # forget the commands of earlier runs, their trace and the file
+        # states the journal cached, so a long-running caller stays small
+        self.queue = collections.OrderedDict()
+        self.ready = {}
+        self.outputs = {}
+        self.costs = {}
+        self.added = {}
+        self.pending = {}
+        self.dependents = {}
+        self.runnable = collections.deque()
+        self.trace = TaskTrace()
+        if self.workers:
+            self.workers.reset()
+        if self.journal:
+            self.journal.checkpoint()
+
+    def add(self, fn, deps, cmd, outputs=None, cost=None):
+        # cost is (cpu slots, memory in MB)
         assert fn not in self.queue
         self.queue[fn] = (fn, deps, cmd)
         self.ready[fn] = False
+        self.added[fn] = time.time()
+        if outputs:
+            self.outputs[fn] = outputs
+        elif fn in self.outputs:
+            del self.outputs[fn]
+        if cost:
+            self.costs[fn] = cost
+        elif fn in self.costs:
+            del self.costs[fn]
+
+    def add_call(self, fn, deps, func, args, outputs=None, cost=None):
+        # run func(*args) in a worker process instead of a command
+        self.add(fn, deps, (func, tuple(args)), outputs=outputs, cost=cost)
+
+    def task_cost(self, fn):
+        return self.costs.get(fn, DEFAULT_COST)
 
-    def next(self):
-        for k in self.queue.keys():
-            (fn, deps, cmd) = self.queue[k]
-            ready = True
+    def fits(self, fn, tasks):
+        # anything may run alone, however large
+        if len(tasks) == 0:
+            return True
+        (cpu, memory) = self.task_cost(fn)
+        if self.used_cpu + cpu > self.n_threads:
+            return False
+        if self.memory_mb is not None and self.used_memory + memory > self.memory_mb:
+            return False
+        return True
+
+    def next_task(self, tasks):
+        # first runnable command that fits in the remaining budgets
+        for i in range(min(len(self.runnable), SCAN_LIMIT)):
+            fn = self.runnable[i]
+            if self.fits(fn, tasks):
+                del self.runnable[i]
+                return fn
+        return None
+
+    def task_outputs(self, fn):
+        return self.outputs.get(fn, [fn])
+
+    def up_to_date(self, fn, deps, cmd):
+        if self.journal:
+            return self.journal.valid(fn, cmd, deps, self.task_outputs(fn))
+        else:
+            # every output, so a task cut short part way is run again
+            return all([os.path.exists(out) for out in self.task_outputs(fn)])
+
+    def temp_names(self, fn):
+        # outputs are written under a temporary name in the same
+        # directory, e.g. raw -> .tmp-raw and raw-avg.png -> .tmp-raw-avg.png
+        names = {}
+        for path in [fn] + self.task_outputs(fn):
+            (head, tail) = os.path.split(path)
+            names[path] = os.path.join(head, TMP_PREFIX + tail)
+        return names
+
+    def spawn(self, fn, cmd):
+        renames = {}
+        if self.journal:
+            renames = self.temp_names(fn)
+        if isinstance(cmd, tuple):
+            if not self.pool:
+                self.workers = WorkerPids()
+                self.pool = multiprocessing.Pool(self.n_threads, _init_worker, (self.workers.queue,))
+            (func, args) = cmd
+            args = tuple([renames.get(a, a) if isinstance(a, str) else a for a in args])
+            task = PoolTask(fn, (func, args), self.notify, self.pool, self.workers)
+        else:
+            task = ProcessTask(fn, [renames.get(a, a) for a in cmd], self.notify)
+        task.renames = renames
+        return task
+
+    def check_outputs(self, task):
+        # a command that exits 0 without writing what it declared has failed,
+        # under the temporary names if there are any
+        missing = [out for out in self.task_outputs(task.fn) if not os.path.lexists(task.renames.get(out, out))]
+        if missing and not task.returncode:
+            print '!', task.fn, 'did not write', ', '.join(missing)
+            task.returncode = 1
+
+    def finish_outputs(self, task):
+        for out in self.task_outputs(task.fn):
+            tmp = task.renames[out]
+            if task.returncode:
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+            elif os.path.lexists(tmp):
+                os.rename(tmp, out)
+        if not task.returncode:
+            (fn, deps, cmd) = task.job
+            self.journal.record(fn, cmd, deps, self.task_outputs(fn))
+
+    def notify(self, task):
+        # called from waiter and pool threads
+        self.finished.append(task)
+        os.write(self.wake_w, '.')
+
+    def wait_finished(self):
+        os.read(self.wake_r, 1)
+        return self.finished.popleft()
+
+    def schedule(self):
+        self.pending = {}
+        self.dependents = {}
+        self.runnable = collections.deque()
+        for (fn, deps, cmd) in self.queue.values():
+            count = 0
             for dep in deps:
                 if dep in self.ready:
-                    ready = ready and self.ready[dep]
-                else:
-                    ready = ready and os.path.exists(dep)
-            if ready:
-                del self.queue[k]
-                return (fn, cmd)
-        return None
-   
-    def sleep(self):
-        time.sleep(0.1)
-
-    def start_task(self, tasks):
-        job = self.next()
-        if job:
-            (fn, cmd) = job
-            if os.path.exists(fn):
-                self.ready[fn] = True
-                print 'ready:', fn
-            else:
-                proc = subprocess.Popen(cmd)
-                print cmd
-                tasks[fn] = { 'p': proc, 'fn': fn, 'cmd': cmd }
-        return job
-
-    def check_tasks(self, tasks):
-        error = None
-        done = []
-        for (fn, task) in tasks.items():
-            if task['p'].poll() is not None:
-                done.append(task)
-        
-        for task in done:
-            if task['p'].returncode:
-                error = task
-            print 'ready:', task['fn']
-            self.ready[task['fn']] = True
-            del tasks[task['fn']]
+                    if not self.ready[dep]:
+                        count += 1
+                        self.dependents.setdefault(dep, []).append(fn)
+                elif not os.path.exists(dep):
+                    # can never be satisfied
+                    count += 1
+            self.pending[fn] = count
+            if count == 0:
+                self.runnable.append(fn)
 
-        if len(done) == 0:
-            self.sleep()
+    def complete(self, fn):
+        print 'ready:', fn
+        self.ready[fn] = True
+        self.added.pop(fn, None)
+        for dependent in self.dependents.pop(fn, []):
+            self.pending[dependent] -= 1
+            if self.pending[dependent] == 0:
+                self.runnable.append(dependent)
 
-        return error
+    def start_task(self, fn, tasks):
+        (fn, deps, cmd) = self.queue.pop(fn)
+        if self.up_to_date(fn, deps, cmd):
+            self.complete(fn)
+        else:
+            tasks[fn] = task = self.spawn(fn, cmd)
+            task.job = (fn, deps, cmd)
+            task.cost = self.task_cost(fn)
+            task.slot = self.trace.take_slot()
+            self.used_cpu += task.cost[0]
+            self.used_memory += task.cost[1]
+            print cmd
+
+    def write_trace(self, path):
+        print 'write trace', path
+        self.trace.write_chrome(path)
+        self.trace.print_summary()
 
     def waiting(self):
-        return len(self.queue.keys())
+        return len(self.queue)
 
     def run(self):
         tasks = {}
         error = None
-        
-        def running():
-            return len(tasks.keys())
-
-        while (self.waiting() > 0) and (not error):
-            while (running() < self.n_threads) and (self.waiting() > 0):
-                job = self.start_task(tasks)
-                # nothing to start?
-                if not job:
-                    if (running() == 0) and (self.waiting() > 0):
-                        # sanity check
-                        print 'CommandQueue has commands which cannot start'
-                        return False
-                    else:
-                        # check for dependencies finishing
-                        break
-
-            error = self.check_tasks(tasks)
-            while (running() == self.n_threads) and (not error):
-                error = self.check_tasks(tasks)
-
-        while running() > 0:
-            self.check_tasks(tasks)
+
+        self.schedule()
+        while True:
+            while (not error) and self.runnable:
+                fn = self.next_task(tasks)
+                if fn is None:
+                    break
+                self.start_task(fn, tasks)
+            if len(tasks) == 0:
+                break
+
+            task = self.wait_finished()
+            del tasks[task.fn]
+            self.used_cpu -= task.cost[0]
+            self.used_memory -= task.cost[1]
+            self.trace.release_slot(task.slot)
+            self.check_outputs(task)
+            if self.journal:
+                self.finish_outputs(task)
+            self.trace.record(task.fn, task.job[2], task.slot, self.added.pop(task.fn, task.start),
+                task.start, task.end, task.returncode, task.usage)
+            if task.returncode and not error:
+                error = task
+            self.complete(task.fn)
 
         if error:
-            print 'failed', error['cmd'] 
+            print 'failed', error.cmd
+            return False
+        elif self.waiting() > 0:
+            # sanity check
+            print 'CommandQueue has commands which cannot start'
             return False
         else:
             return True
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+from image_io import QUANTUM_RANGE, load_image, to_char
+
+# as base_images.normalize
+INTENSITY = [0.299, 0.587, 0.114]
+EDGES_SIZE = (128, 128)
+MEDIAN_SIZE = 2
+LAT_SIZE = 2
+LAT_OFFSET = -0.05
+BLUR_SIGMA = 1.0
+# rough resident bytes per pixel of derive_images: the decoded average, its
+# equalized copy and their intensity and index planes
+DERIVE_BYTES_PER_PIXEL = 120
+
+# each step rounds to whole quantum values, as ImageMagick's Q16 does
+
+def quantum(px):
+    return np.clip(np.rint(px), 0, QUANTUM_RANGE)
+
+def equalize(px):
+    # -equalize: one map for all channels, from the intensity histogram
+    if px.ndim == 3:
+        intensity = np.dot(px, INTENSITY)
+    else:
+        intensity = px
+    hist = np.bincount(quantum(intensity).astype(np.intp).ravel(), minlength=int(QUANTUM_RANGE) + 1)
+    cdf = np.cumsum(hist).astype(np.float64)
+    (black, white) = (cdf[0], cdf[-1])
+    if white == black:
+        return px
+    equalize_map = quantum(QUANTUM_RANGE * (cdf - black) / (white - black))
+    return equalize_map[quantum(px).astype(np.intp)]
+
+def gray_average(px):
+    # -separate -average
+    return quantum(np.mean(px, axis=2))
+
+def scale(px, size):
+    # -scale WxH!, averaging the area each output pixel covers
+    img = Image.fromarray(px.astype(np.float32), 'F').resize(size, Image.BOX)
+    return quantum(np.asarray(img, dtype=np.float64))
+
+def median(px, size=MEDIAN_SIZE):
+    # -median 2, a 2x2 neighbourhood to the upper left, edge pixels repeated
+    return ndimage.median_filter(px, size=size, mode='nearest')
+
+def adaptive_threshold(px, size=LAT_SIZE, offset=LAT_OFFSET):
+    # -lat 2x2-5%: white where a pixel is over its neighbourhood mean plus
+    # the offset (a fraction of the quantum range)
+    mean = ndimage.uniform_filter(px, size=size, mode='nearest')
+    return np.where(px <= mean + offset * QUANTUM_RANGE, 0.0, QUANTUM_RANGE)
+
+def negate(px):
+    return QUANTUM_RANGE - px
+
+def blur(px, sigma=BLUR_SIGMA):
+    # -blur 0x1, the kernel reaching 4 sigma as ImageMagick picks at Q16
+    return quantum(ndimage.gaussian_filter(px, sigma, mode='nearest', truncate=4.0))
+
+def save(path, px):
+    Image.fromarray(to_char(px)).save(path)
+
+def derive_images(src, eq, eq_gray, gray_eq, gray_edges):
+    # decode once and share the equalized image and the gray averages
+    px = load_image(src)
+    equalized = equalize(px)
+    # convert -equalize
+    save(eq, equalized)
+    # convert -equalize -separate -average
+    equalized_gray = gray_average(equalized)
+    save(eq_gray, equalized_gray)
+    # convert -separate -average -equalize
+    save(gray_eq, equalize(gray_average(px)))
+    # convert -equalize -separate -average -scale 128x128! -median 2
+    #   -lat 2x2-5% -negate -colorspace gray -blur 0x1
+    # the image is already gray, so -colorspace gray leaves it as it is
+    edges = median(scale(equalized_gray, EDGES_SIZE))
+    save(gray_edges, blur(negate(adaptive_threshold(edges))))
+    return True
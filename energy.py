@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy.signal import correlate, lfilter
+
+ENERGIES = ['energy1', 'energy2', 'energy3', 'energy4']
+# energy2 looks this many days ahead, weighting day i + j by 1 / j
+LOOK_AHEAD = 29
+# days filtered at a time when the smoothed value is being clipped
+SEGMENT = 256
+
+def summarise(values, metrics=None):
+    # values is [day, measure, series, metric], missing values count as 0;
+    # each metric is scaled by its geometric mean over the nonzero values of
+    # all days and series (the first day never has a prev value, a metric
+    # with none stays 0), then series and metrics are averaged, giving
+    # [measure, day]
+    if metrics is not None:
+        values = values[..., metrics]
+    v = np.where(np.isnan(values), 0.0, values)
+    present = v > 0.0
+    logs = np.where(present, np.log(np.where(present, v, 1.0)), 0.0)
+    g = np.exp(np.sum(logs, axis=(0, 2)) / np.maximum(np.sum(present, axis=(0, 2)), 1))
+    scaled = v / g[np.newaxis, :, np.newaxis, :]
+    return np.mean(np.mean(scaled, axis=2), axis=2).T
+
+def standardise(ys, scale=1.0):
+    m = np.mean(ys, axis=-1)[..., np.newaxis]
+    sd = np.std(ys, axis=-1)[..., np.newaxis]
+    return (ys - m) / (scale * sd)
+
+def look_ahead(x):
+    # sum of x[i + j] / j over the next LOOK_AHEAD days, past the end x is 1
+    pad = np.ones(x.shape[:-1] + (LOOK_AHEAD,))
+    xp = np.concatenate([x[..., 1:], pad], axis=-1)
+    kernel = 1.0 / np.arange(1, LOOK_AHEAD + 1)
+    return correlate(xp, kernel.reshape((1,) * (x.ndim - 1) + (-1,)), mode='valid', method='direct')
+
+def smooth_row(v, decay, gain, e0):
+    # restart the filter from the clipped value each time it leaves 0..1
+    out = np.empty(len(v))
+    e = e0
+    start = 0
+    while start < len(v):
+        # skip runs where the value stays pinned at a limit
+        if e == 0.0 or e == 1.0:
+            rest = v[start:start + SEGMENT]
+            if e == 0.0:
+                pinned = (e * decay + rest * gain) <= 0.0
+            else:
+                pinned = (e * decay + rest * gain) >= 1.0
+            n = len(rest) if np.all(pinned) else np.argmin(pinned)
+            out[start:start + n] = e
+            start += n
+            if n > 0:
+                continue
+        y = lfilter([gain], [1.0, -decay], v[start:start + SEGMENT], zi=[decay * e])[0]
+        clipped = np.nonzero((y < 0.0) | (y > 1.0))[0]
+        if len(clipped) == 0:
+            out[start:start + len(y)] = y
+            e = y[-1]
+            start += len(y)
+        else:
+            k = clipped[0]
+            out[start:start + k] = y[:k]
+            e = out[start + k] = min(max(y[k], 0.0), 1.0)
+            start += k + 1
+    return out
+
+def smooth(v, decay, gain, e0):
+    # e[i] = clip(e[i - 1] * decay + v[i] * gain, 0, 1) along the last axis,
+    # as one linear filter for rows that never clip
+    v = np.atleast_2d(v)
+    zi = np.empty((v.shape[0], 1))
+    zi.fill(decay * e0)
+    out = lfilter([gain], [1.0, -decay], v, axis=-1, zi=zi)[0]
+    for row in np.nonzero(np.any((out < 0.0) | (out > 1.0), axis=-1))[0]:
+        out[row] = smooth_row(v[row], decay, gain, e0)
+    return out
+
+def energy1(ys):
+    return np.clip(standardise(ys), 0.0, 1.0)
+
+def energy2(ys):
+    return smooth(look_ahead(standardise(ys)), 0.95, 0.05, 1.0)
+
+def energy3(ys):
+    return smooth(standardise(ys, scale=1.5), 0.7, 0.3, 0.0)
+
+def energy4(ys, e2=None, e3=None):
+    if e2 is None:
+        e2 = energy2(ys)
+    if e3 is None:
+        e3 = energy3(ys)
+    v2 = e2 * 0.7
+    return np.where(v2 >= 0.7, v2 + e3 * 0.3, v2)
+
+def diff_energy(ys):
+    return smooth(ys, 0.9, 0.1, 0.5)
+
+def energies(ys):
+    # ys is [measure, day], returns [measure, energy, day] in ENERGIES order
+    ys = np.atleast_2d(ys)
+    e2 = energy2(ys)
+    e3 = energy3(ys)
+    return np.stack([energy1(ys), e2, e3, energy4(ys, e2, e3)], axis=1)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os, os.path
+
+import numpy as np
+
+from image_io import load_image
+
+CROP = 0.8
+GRID = 3
+BATCH = 32
+N_VALUES = GRID * GRID * 3
+
+def crop_box(width, height, crop=CROP):
+    # matches convert -gravity center -crop 80%
+    w = int(np.floor(width * crop + 0.5))
+    h = int(np.floor(height * crop + 0.5))
+    x = (width // 2) - (w // 2)
+    y = (height // 2) - (h // 2)
+    return (x, y, w, h)
+
+def area_weights(n, m):
+    # fraction of each of n input pixels covered by each of m outputs,
+    # as used by convert -scale
+    edges = np.arange(m + 1) * (float(n) / m)
+    lo = np.arange(n)
+    start = np.maximum(lo[np.newaxis, :], edges[:-1, np.newaxis])
+    end = np.minimum(lo[np.newaxis, :] + 1, edges[1:, np.newaxis])
+    w = np.clip(end - start, 0.0, None)
+    return w / w.sum(axis=1)[:, np.newaxis]
+
+def reduce_batch(batch):
+    # batch is (n, h, w, 3); returns (n, GRID, GRID, 3)
+    (h, w) = batch.shape[1:3]
+    wy = area_weights(h, GRID)
+    wx = area_weights(w, GRID)
+    return np.einsum('yh,nhwc,xw->nyxc', wy, batch, wx)
+
+def fingerprint_batch(paths):
+    result = np.zeros((len(paths), N_VALUES), dtype=np.int64)
+    groups = {}
+    for (i, path) in enumerate(paths):
+        if not os.path.exists(path):
+            print '! missing', path
+            continue
+        px = load_image(path)
+        (x, y, w, h) = crop_box(px.shape[1], px.shape[0])
+        px = px[y:y + h, x:x + w]
+        groups.setdefault(px.shape, []).append((i, px))
+    for entries in groups.values():
+        idx = [i for (i, px) in entries]
+        scaled = reduce_batch(np.array([px for (i, px) in entries]))
+        result[idx] = np.rint(scaled.reshape(len(idx), N_VALUES))
+    return result
+
+def fingerprint_images(paths, n_threads=None, batch=BATCH):
+    # decode in batches, spread over worker processes if there are many
+    batches = [paths[i:i + batch] for i in range(0, len(paths), batch)]
+    if len(batches) > 1 and n_threads != 1:
+        if n_threads is None:
+            n_threads = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(min(n_threads, len(batches)))
+        results = pool.map(fingerprint_batch, batches)
+        pool.close()
+        pool.join()
+    else:
+        results = [fingerprint_batch(b) for b in batches]
+    if len(results) == 0:
+        return np.zeros((0, N_VALUES), dtype=np.int64)
+    return np.concatenate(results)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import collections
+import os, os.path
+
+from append_log import append_record, file_key, read_records, write_records
+
+STORE_NAME = 'fp_store'
+MAX_ENTRIES = 250000
+
+# append-only on-disk fingerprint cache, validated against the files
+# themselves and trimmed least recently used first
+class FingerprintStore:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.root = None
+        self.log = None
+        self.entries = collections.OrderedDict()
+        self.records = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.dirty = False
+
+    def path(self):
+        return os.path.join(self.root, STORE_NAME)
+
+    def relative(self, path):
+        if self.root:
+            return os.path.relpath(path, self.root)
+        return path
+
+    def open(self, root):
+        self.close()
+        self.root = root
+        self.entries = collections.OrderedDict()
+        self.records = 0
+        (records, damaged) = read_records(self.path())
+        for (rel, key, fp) in records:
+            if rel in self.entries:
+                del self.entries[rel]
+            self.entries[rel] = (key, fp)
+        self.records = len(records)
+        if self.records > 0:
+            print 'fingerprint store: loaded %d entries' % len(self.entries)
+        self.evict()
+        if damaged or self.dirty or self.records > 2 * len(self.entries):
+            self.compact()
+        self.log = open(self.path(), 'ab')
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+            if self.dirty or self.records > 2 * len(self.entries):
+                self.compact()
+            print 'fingerprint store: %d hits, %d misses, %d entries, %d evicted' % (
+                self.hits, self.misses, len(self.entries), self.evicted)
+
+    def compact(self):
+        write_records(self.path(), [(rel, key, fp) for (rel, (key, fp)) in self.entries.items()])
+        self.records = len(self.entries)
+        self.dirty = False
+
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+            self.dirty = True
+
+    def get(self, path):
+        rel = self.relative(path)
+        entry = self.entries.get(rel)
+        if entry and os.path.exists(path) and entry[0] == file_key(path):
+            # move to the most recently used end
+            del self.entries[rel]
+            self.entries[rel] = entry
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def contains(self, path):
+        # as get, but neither counted nor moved, for checks ahead of a get
+        entry = self.entries.get(self.relative(path))
+        return bool(entry) and os.path.exists(path) and entry[0] == file_key(path)
+
+    def put(self, path, fp):
+        if not os.path.exists(path):
+            return
+        rel = self.relative(path)
+        key = file_key(path)
+        if rel in self.entries:
+            del self.entries[rel]
+        self.entries[rel] = (key, fp)
+        if self.log:
+            append_record(self.log, (rel, key, fp))
+            self.records += 1
+        self.evict()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# share of the frames spread evenly over buckets before easing by energy
+MINIMUM_SHARE = 0.25
+
+def largest_remainder(quotas, total):
+    # round quotas to integers summing to exactly total, spare frames go
+    # to the largest fractional parts, earlier buckets first on ties
+    quotas = np.asarray(quotas, dtype=np.float64)
+    counts = np.floor(quotas)
+    spare = int(round(total - np.sum(counts)))
+    fractions = quotas - counts
+    if spare > 0:
+        order = np.argsort(-fractions, kind='mergesort')
+        counts[order[:spare]] += 1
+    elif spare < 0:
+        order = np.argsort(np.where(counts > 0, fractions, np.inf), kind='mergesort')
+        counts[order[:-spare]] -= 1
+    return counts.astype(np.int64)
+
+def allocate(energy, total, keep=None, minimum_share=MINIMUM_SHARE):
+    # frames per bucket: at least one each (or minimum_share of the total
+    # spread evenly) with the rest in proportion to energy, excluded
+    # buckets get none
+    energy = np.asarray(energy, dtype=np.float64)
+    if keep is None:
+        keep = np.ones(len(energy), dtype=bool)
+    n = np.count_nonzero(keep)
+    counts = np.zeros(len(energy), dtype=np.int64)
+    if n == 0:
+        return counts
+    min_f = max(1.0, (float(total) * minimum_share) / float(n))
+    r_frames = total - n * min_f
+    if r_frames < 0:
+        raise ValueError('insufficient frames available')
+    e = energy[keep]
+    if np.sum(e) > 0.0:
+        quotas = min_f + r_frames * (e / np.sum(e))
+    else:
+        quotas = np.empty(n)
+        quotas.fill(float(total) / n)
+    counts[keep] = largest_remainder(quotas, total)
+    return counts
+
+def redistribute(counts, keep):
+    # move the frames of excluded buckets to the others, in proportion
+    counts = np.asarray(counts, dtype=np.float64)
+    total = int(round(np.sum(counts)))
+    result = np.zeros(len(counts), dtype=np.int64)
+    kept = counts[keep]
+    if len(kept) > 0 and np.sum(kept) > 0.0:
+        result[keep] = largest_remainder(kept * (total / np.sum(kept)), total)
+    return result
+
+def weekdays(keys):
+    # 0 for Monday to 6 for Sunday, keys start 'yyyymmdd'
+    dates = np.array(['%s-%s-%s' % (k[0:4], k[4:6], k[6:8]) for k in keys], dtype='M8[D]')
+    return (dates.astype(np.int64) + 3) % 7
+
+def weekends():
+    return lambda keys, energy: weekdays(keys) < 5
+
+def date_range(arg):
+    # 'first-last', either may be left out, compared as yyyymmdd
+    (first, last) = arg.split('-')
+    def keep(keys, energy):
+        days = np.array([int(k[0:8]) for k in keys])
+        mask = np.ones(len(keys), dtype=bool)
+        if first:
+            mask &= (days >= int(first))
+        if last:
+            mask &= (days <= int(last))
+        return mask
+    return keep
+
+def holidays(path):
+    # a file of yyyymmdd days to leave out, one per line
+    with open(path, 'r') as f:
+        days = set([line.strip() for line in f if line.strip()])
+    return lambda keys, energy: np.array([k[0:8] not in days for k in keys], dtype=bool)
+
+def min_energy(arg):
+    threshold = float(arg)
+    def keep(keys, energy):
+        if energy is None:
+            raise ValueError('min-energy needs energy values')
+        return np.asarray(energy) >= threshold
+    return keep
+
+FILTERS = {
+    'weekends': weekends,
+    'range': date_range,
+    'holidays': holidays,
+    'min-energy': min_energy
+}
+
+def parse_filter(spec):
+    # 'weekends', 'range:20140501-20140630', 'holidays:<file>' or 'min-energy:0.05'
+    (name, sep, arg) = spec.partition(':')
+    if name not in FILTERS:
+        raise ValueError('unknown filter ' + spec)
+    if sep:
+        return FILTERS[name](arg)
+    return FILTERS[name]()
+
+def apply_filters(specs, keys, energy=None):
+    keep = np.ones(len(keys), dtype=bool)
+    for spec in specs:
+        keep &= parse_filter(spec)(keys, energy)
+    return keep
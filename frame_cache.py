@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import collections
+
+import numpy as np
+
+from image_io import load_image
+
+CACHE_MB = 1024
+
+# decoded source frames held as 16-bit RGB, load_image values are whole
+# numbers so nothing is lost, dropped least recently used first once the
+# total size passes the cap
+class FrameCache:
+    def __init__(self, max_mb=CACHE_MB):
+        self.max_bytes = max_mb << 20
+        self.frames = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_decoded = 0
+        self.evicted = 0
+
+    def set_limit(self, max_mb):
+        self.max_bytes = max_mb << 20
+        self.evict()
+
+    def get(self, path):
+        px = self.frames.pop(path, None)
+        if px is None:
+            self.misses += 1
+            px = np.rint(load_image(path)).astype(np.uint16)
+            self.bytes_decoded += px.nbytes
+            self.bytes += px.nbytes
+        else:
+            self.hits += 1
+        self.frames[path] = px
+        self.evict()
+        return px
+
+    def evict(self):
+        # the frame just used always stays
+        while self.bytes > self.max_bytes and len(self.frames) > 1:
+            (path, px) = self.frames.popitem(last=False)
+            self.bytes -= px.nbytes
+            self.evicted += 1
+
+    def counters(self):
+        return (self.hits, self.misses, self.bytes_decoded, self.evicted)
+
+    def summary(self, since=(0, 0, 0, 0)):
+        # counters since an earlier counters() value
+        (hits, misses, decoded, evicted) = [a - b for (a, b) in zip(self.counters(), since)]
+        return 'frame cache: %d hits, %d misses, %.1f MB decoded, %d evicted' % (
+            hits, misses, decoded / float(1 << 20), evicted)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+import calendar
+import datetime
+import os, os.path
+
+import numpy as np
+
+INDEX_NAME = 'frame_index.npy'
+PERIODS = ['night', 'dawn', 'day', 'dusk']
+# allocation buckets by key length, a day, an hour or a minute
+BUCKETS = {
+    8: ('%Y%m%d', datetime.timedelta(days=1)),
+    10: ('%Y%m%d%H', datetime.timedelta(hours=1)),
+    12: ('%Y%m%d%H%M', datetime.timedelta(minutes=1))
+}
+
+DTYPE = np.dtype([
+    ('name', 'S32'),            # source file name
+    ('ts', 'i8'),               # shifted local time as seconds since 1970
+    ('shift', 'i4'),            # time shift applied, in seconds
+    ('period', 'i1'),           # index into PERIODS
+    ('day', 'i4'),              # yyyymmdd
+    ('dayno', 'i4'),            # proleptic ordinal of the day
+    ('month', 'i4')             # yyyymm
+])
+
+def to_ts(dt):
+    return calendar.timegm(dt.timetuple())
+
+def from_ts(ts):
+    return datetime.datetime.utcfromtimestamp(int(ts))
+
+def day_key(dayno):
+    return datetime.date.fromordinal(int(dayno)).strftime('%Y%m%d')
+
+def bucket_range(key):
+    # 'yyyymmdd', 'yyyymmddhh' or 'yyyymmddhhmm' to [start, end) timestamps
+    if len(key) not in BUCKETS:
+        raise ValueError('bad time bucket ' + key)
+    (fmt, step) = BUCKETS[len(key)]
+    start = datetime.datetime.strptime(key, fmt)
+    return (to_ts(start), to_ts(start + step))
+
+def group_rows(keys, rows):
+    # split rows by key value, e.g. {20140501: array([0, 1, 5])}
+    if len(rows) == 0:
+        return {}
+    (values, inverse) = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind='mergesort')
+    bounds = np.searchsorted(inverse[order], np.arange(1, len(values)))
+    return dict(zip(values.tolist(), np.split(rows[order], bounds)))
+
+# one row per source frame, sorted by time
+class FrameIndex:
+    def __init__(self):
+        self.root = None
+        self.rows = np.zeros(0, dtype=DTYPE)
+        self.by_name = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def names(self):
+        if self.by_name is None:
+            self.by_name = dict(zip(self.rows['name'].tolist(), range(len(self.rows))))
+        return self.by_name
+
+    def find(self, name):
+        return self.names().get(name)
+
+    def add(self, entries, classify):
+        # entries are (name, datetime, shift seconds), classify gives
+        # period codes for arrays of timestamps and day numbers
+        new = np.zeros(len(entries), dtype=DTYPE)
+        for (i, (name, dt, shift)) in enumerate(entries):
+            new[i]['name'] = name
+            new[i]['ts'] = to_ts(dt)
+            new[i]['shift'] = shift
+            new[i]['day'] = dt.year * 10000 + dt.month * 100 + dt.day
+            new[i]['dayno'] = dt.date().toordinal()
+            new[i]['month'] = dt.year * 100 + dt.month
+        new['period'] = classify(new['ts'], new['dayno'])
+        keep = np.ones(len(self.rows), dtype=bool)
+        for name in new['name']:
+            i = self.find(name)
+            if i is not None:
+                keep[i] = False
+        rows = np.concatenate([self.rows[keep], new])
+        self.rows = rows[np.argsort(rows['ts'], kind='mergesort')]
+        self.by_name = None
+        return self.select_names(new['name'])
+
+    def retain(self, names):
+        # drop rows for frames no longer in the archive
+        keep = np.in1d(self.rows['name'], np.array(list(names), dtype=DTYPE['name']))
+        if not np.all(keep):
+            self.rows = self.rows[keep]
+            self.by_name = None
+
+    def reclassify(self, classify):
+        # (row, old period) for each frame that moved to a different period
+        periods = classify(self.rows['ts'], self.rows['dayno'])
+        moved = np.nonzero(periods != self.rows['period'])[0]
+        old = [PERIODS[p] for p in self.rows['period'][moved]]
+        self.rows['period'] = periods
+        return zip(moved.tolist(), old)
+
+    def select_names(self, names):
+        return np.array([self.find(name) for name in names], dtype=np.intp)
+
+    def dt(self, i):
+        return from_ts(self.rows['ts'][i])
+
+    def period(self, i):
+        return PERIODS[self.rows['period'][i]]
+
+    def day(self, i):
+        return '%08d' % self.rows['day'][i]
+
+    def img_path(self, i, img_type):
+        # e.g. 20140514/day/20140514021632-ld.png
+        return os.path.join(self.day(i), self.period(i), self.frame_name(i, img_type))
+
+    def frame_name(self, i, img_type='hd'):
+        return self.dt(i).strftime('%Y%m%d%H%M%S') + '-' + img_type + '.png'
+
+    def frame_names(self, rows, img_type='hd'):
+        # frame_name for many rows at once, from 'yyyy-mm-ddThh:mm:ss'
+        iso = np.datetime_as_string(self.rows['ts'][rows].astype('M8[s]')).astype('S19')
+        digits = iso.view(np.uint8).reshape(-1, 19)[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]]
+        return np.char.add(np.ascontiguousarray(digits).view('S14').ravel(), '-' + img_type + '.png')
+
+    def bucket_rows(self, key, rows):
+        # the part of rows, sorted by time, that falls in a time bucket
+        (start, end) = bucket_range(key)
+        (lo, hi) = np.searchsorted(self.rows['ts'][rows], [start, end])
+        return rows[lo:hi]
+
+    def days(self, rows=None):
+        if rows is None:
+            rows = slice(None)
+        return ['%08d' % d for d in np.unique(self.rows['day'][rows])]
+
+    def select(self, day=None, month=None, period=None, first_day=None, last_day=None):
+        # row ids matching all the given conditions
+        mask = np.ones(len(self.rows), dtype=bool)
+        if day is not None:
+            mask &= (self.rows['day'] == int(day))
+        if month is not None:
+            mask &= (self.rows['month'] == int(month))
+        if first_day is not None:
+            mask &= (self.rows['day'] >= int(first_day))
+        if last_day is not None:
+            mask &= (self.rows['day'] <= int(last_day))
+        if period is not None and period != 'all':
+            mask &= (self.rows['period'] == PERIODS.index(period))
+        return np.nonzero(mask)[0]
+
+    def buckets(self, rows=None):
+        # average buckets, e.g. 'day/20140514/all' -> row ids
+        if rows is None:
+            rows = np.arange(len(self.rows))
+        rows = np.asarray(rows, dtype=np.intp)
+        r = self.rows[rows]
+        parts = {}
+
+        def add(kind, keys, name):
+            for (key, members) in group_rows(keys, rows).items():
+                parts.setdefault(os.path.join(kind, name(key), 'all'), []).append(members)
+            for (p, period) in enumerate(PERIODS):
+                sel = (r['period'] == p)
+                for (key, members) in group_rows(keys[sel], rows[sel]).items():
+                    parts.setdefault(os.path.join(kind, name(key), period), []).append(members)
+
+        add('day', r['day'], lambda k: '%08d' % k)
+        add('month', r['month'], lambda k: '%06d' % k)
+        # a frame counts towards the 5day average of each day within 2 days
+        for offset in range(-2, 3):
+            add('5day', r['dayno'] + offset, day_key)
+
+        return dict([(key, np.sort(np.concatenate(members)))
+            for (key, members) in parts.items()])
+
+    def path(self):
+        return os.path.join(self.root, INDEX_NAME)
+
+    def open(self, root, mmap=False):
+        self.root = root
+        self.rows = np.zeros(0, dtype=DTYPE)
+        self.by_name = None
+        if os.path.exists(self.path()):
+            rows = np.load(self.path(), mmap_mode='r' if mmap else None)
+            if rows.dtype == DTYPE:
+                self.rows = rows
+            else:
+                print '! frame index format changed, rebuilding'
+
+    def save(self):
+        if self.root is None:
+            return
+        tmp = self.path() + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, self.rows)
+        os.rename(tmp, self.path())
+
+    def close(self):
+        self.save()
+        self.root = None
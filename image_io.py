@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import numpy as np
+from PIL import Image
+
+# pixel values are held in the same range as ImageMagick's (Q16)
+# MagickPixelPacket so results line up with avgimg and convert
+QUANTUM_RANGE = 65535.0
+CHAR_TO_QUANTUM = QUANTUM_RANGE / 255.0
+
+def decode_image(path):
+    # the pixels as stored, 16-bit gray or 8-bit RGB
+    img = Image.open(path)
+    if img.mode not in ('I;16', 'I;16B', 'I', 'RGB'):
+        img = img.convert('RGB')
+    return np.asarray(img)
+
+def to_quantum(px):
+    # decode_image pixels, or rows of them, in the quantum range
+    if px.ndim == 2:
+        px = px.astype(np.float64)
+        return np.dstack([px, px, px])
+    return px.astype(np.float64) * CHAR_TO_QUANTUM
+
+def load_image(path):
+    return to_quantum(decode_image(path))
+
+def to_char(px):
+    return np.clip(np.rint(px / CHAR_TO_QUANTUM), 0, 255).astype(np.uint8)
+
+def save_image(path, px):
+    px = to_char(px)
+    if px.ndim == 3 and px.shape[2] == 1:
+        px = px[:, :, 0]
+    Image.fromarray(px).save(path)
+
+def image_size(path):
+    img = Image.open(path)
+    return img.size
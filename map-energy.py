@@ -1,10 +1,30 @@
 #!/usr/bin/env python
 
-import math
 import pickle
 import sys
 
+import numpy as np
+
+import frame_alloc
+
+def parse_filters(args):
+    # -f <filter> leaves buckets out, see frame_alloc.parse_filter
+    filters = []
+    while '-f' in args:
+        i = args.index('-f')
+        filters.append(args[i + 1])
+        args = args[:i] + args[i + 2:]
+    return (args, filters)
+
+def energy_values(data, major, minor):
+    # energy is indexed [measure, energy kind, day], files written before
+    # the measure store hold a list per day under data[measure][kind]
+    if 'energy' in data:
+        return data['energy'][data['measures'].index(major), data['energies'].index(minor)]
+    return np.array(data[major][minor], dtype=np.float64)
+
 def main(args):
+    (args, filters) = parse_filters(args)
     if len(args) >= 3:
         (data_file, frames) = args[0:2]
         with open(data_file, 'rb') as f:
@@ -12,47 +32,29 @@ def main(args):
         frames = int(frames)
         days = data['days']
 
-        # ~25% of the frames are dedicated per day
-        min_f = (float(frames) * 0.25) / float(len(days))
-        if min_f < 1.0:
-            min_f = 1.0
-
-        selected = [ 1.0 ] * len(days)
+        selected = np.ones(len(days))
         for measure in args[2:]:
             if measure.find(':') >= 0:
                 (major, minor) = measure.split(':', 2)
             else:
                 (major, minor) = (measure, 'energy4')
-            md = data[major][minor]
-            for i in range(len(md)):
-                selected[i] *= md[i]
-
-        #for i in range(len(selected)):
-        #    selected[i] = selected[i] / (1.0 * len(args[2:]))
-            #selected[i] = min(selected[i], 1.0)
-        
-        r_frames = frames - (len(days) * min_f)
-        if r_frames < 0:
-            print 'insufficient frames available'
-            sys.exit(0)
+            selected *= energy_values(data, major, minor)
 
-        day_frames = [ float(min_f) ] * len(days)
-        total_energy = sum(selected)
+        #selected = np.minimum(selected / (1.0 * len(args[2:])), 1.0)
 
-        last_r_frames = 0
-        while (not (r_frames == last_r_frames)): 
-            frames_per_e = float(r_frames) / total_energy
-            for i in range(len(selected)):
-                day_frames[i] = math.floor(day_frames[i] + (frames_per_e * selected[i]) + 0.5)
-            last_r_frames = r_frames 
-            r_frames = frames - sum(day_frames)
-        
-        #print 'error', r_frames
+        keep = frame_alloc.apply_filters(filters, days, selected)
+        try:
+            # ~25% of the frames are dedicated per day
+            day_frames = frame_alloc.allocate(selected, frames, keep=keep)
+        except ValueError as e:
+            print e
+            sys.exit(0)
 
         for (day, n) in zip(days, range(len(days))):
-            print day, day_frames[n]
+            if keep[n]:
+                print day, float(day_frames[n])
     else:
-        print 'map.py', '<data-file>', '<measure>', '<frames>'
+        print 'map-energy.py <energy-file> <frames> <measure>[:<energy>]... [-f <filter>]...'
 
 if __name__ == "__main__":
     main(sys.argv[1:])
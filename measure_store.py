@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import json
+import os, os.path
+
+import numpy as np
+
+STORE_NAME = 'measure_store'
+HEADER = 'header.json'
+SERIES = ['prev', '5day', 'month']
+METRICS = ['3x3', 'MSE', 'PSNR']
+TONE_VALUES = 3
+FP_VALUES = 27
+
+def columns(n_measures):
+    # one file per column, each a run of fixed size per-day records
+    return [
+        ('values', np.float64, (n_measures, len(SERIES), len(METRICS))),
+        ('tones', np.float64, (n_measures, TONE_VALUES)),
+        ('fps', np.int32, (n_measures, FP_VALUES))
+    ]
+
+def record_size(dtype, shape):
+    return np.dtype(dtype).itemsize * int(np.prod(shape))
+
+# per-day measures as dense arrays indexed [day, measure, ...], days
+# are appended in place and the columns can be memory-mapped
+class MeasureStore:
+    def __init__(self):
+        self.root = None
+        self.measures = []
+        self.writable = False
+        self.days = np.zeros(0, dtype=np.int32)
+        self.values = None
+        self.tones = None
+        self.fps = None
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def header(self):
+        return { 'measures': self.measures, 'series': SERIES, 'metrics': METRICS }
+
+    def open(self, root, measures=None):
+        # giving the measures opens the store for writing
+        self.root = root
+        self.writable = (measures is not None)
+        header = None
+        if os.path.exists(self.path(HEADER)):
+            with open(self.path(HEADER), 'r') as f:
+                header = json.load(f)
+        if self.writable:
+            self.measures = list(measures)
+            if header != self.header():
+                if header is not None:
+                    print '! measures changed, starting a new measure store'
+                self.create()
+        elif header is None:
+            raise IOError('no measure store in ' + root)
+        else:
+            self.measures = header['measures']
+        self.map()
+
+    def create(self):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        for name in ['days'] + [c[0] for c in columns(len(self.measures))]:
+            open(self.path(name), 'wb').close()
+        with open(self.path(HEADER), 'w') as f:
+            json.dump(self.header(), f)
+
+    def map(self):
+        # the days file is written last, so it says how many records are complete
+        self.days = np.fromfile(self.path('days'), dtype=np.int32)
+        n = len(self.days)
+        mode = 'r+' if self.writable else 'r'
+        for (name, dtype, shape) in columns(len(self.measures)):
+            size = n * record_size(dtype, shape)
+            if self.writable and os.path.getsize(self.path(name)) != size:
+                with open(self.path(name), 'r+b') as f:
+                    f.truncate(size)
+            if n > 0:
+                a = np.memmap(self.path(name), dtype=dtype, mode=mode, shape=(n,) + shape)
+            else:
+                a = np.zeros((0,) + shape, dtype=dtype)
+            setattr(self, name, a)
+
+    def close(self):
+        for name in ['values', 'tones', 'fps']:
+            a = getattr(self, name)
+            if isinstance(a, np.memmap):
+                a.flush()
+            setattr(self, name, None)
+        self.root = None
+
+    def retain(self, days):
+        # drop days no longer in the archive, rewriting each column
+        keep = np.in1d(self.days, np.array([int(day) for day in days], dtype=np.int32))
+        if np.all(keep):
+            return
+        for (name, dtype, shape) in columns(len(self.measures)) + [('days', np.int32, ())]:
+            kept = np.array(getattr(self, name)[keep], dtype=dtype)
+            setattr(self, name, None)
+            tmp = self.path(name) + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(kept.tobytes())
+            os.rename(tmp, self.path(name))
+        self.map()
+
+    def record(self, results):
+        # arrays for one day of measure_day results, missing values are NaN
+        values = np.empty((len(self.measures), len(SERIES), len(METRICS)))
+        values.fill(np.nan)
+        tones = np.zeros((len(self.measures), TONE_VALUES))
+        fps = np.zeros((len(self.measures), FP_VALUES), dtype=np.int32)
+        for (m, measure) in enumerate(self.measures):
+            r = results.get(measure)
+            if not r:
+                continue
+            for (s, series) in enumerate(SERIES):
+                if r.get(series):
+                    values[m, s] = [r[series][metric] for metric in METRICS]
+            tones[m] = r['tone']
+            fps[m] = r['fp']
+        return { 'values': values, 'tones': tones, 'fps': fps }
+
+    def update(self, data, days=None):
+        # data maps 'yyyymmdd' to measure_day results for each measure,
+        # days (if given) are all the days to keep
+        if days is not None:
+            self.retain(days)
+        appended = []
+        for day in sorted(data.keys()):
+            record = self.record(data[day])
+            rows = np.nonzero(self.days == int(day))[0]
+            if len(rows) > 0:
+                for (name, a) in record.items():
+                    getattr(self, name)[rows[0]] = a
+            else:
+                for (name, a) in record.items():
+                    with open(self.path(name), 'ab') as f:
+                        f.write(a.tobytes())
+                appended.append(int(day))
+        for name in ['values', 'tones', 'fps']:
+            a = getattr(self, name)
+            if isinstance(a, np.memmap):
+                a.flush()
+        if appended:
+            with open(self.path('days'), 'ab') as f:
+                f.write(np.array(appended, dtype=np.int32).tobytes())
+            self.map()
+
+    def ordered(self):
+        # (days, values, tones, fps) in day order
+        order = np.argsort(self.days, kind='mergesort')
+        days = ['%08d' % d for d in self.days[order]]
+        return (days, self.values[order], self.tones[order], self.fps[order])
+
+    def measure(self, name):
+        return self.measures.index(name)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import math
+import os, os.path
+
+import numpy as np
+
+from image_io import QUANTUM_RANGE, load_image
+import fingerprints
+
+def empty_result():
+    return { '3x3': 0.0, 'MSE': 0.0, 'PSNR': 0.0 }
+
+def psnr(mse):
+    # as reported by compare -metric PSNR on the normalized MSE
+    if mse <= 0.0:
+        return float('inf')
+    return 10.0 * math.log10(1.0 / mse)
+
+def rsd(a, b):
+    return math.sqrt(np.sum((np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)) ** 2))
+
+def mse_batch(srcs, dsts):
+    # normalized MSE (0..1) as printed in brackets by compare -metric MSE
+    d = (srcs - dsts) / QUANTUM_RANGE
+    return np.mean(d * d, axis=(1, 2, 3))
+
+def score_pairs(pairs):
+    # load every image once and score all (src, dst) pairs together,
+    # returns the results and the fingerprints of the loaded images
+    images = {}
+    for pair in pairs:
+        for path in pair:
+            if path in images:
+                continue
+            if os.path.exists(path):
+                images[path] = load_image(path)
+            else:
+                print '! missing', path
+                images[path] = None
+
+    fps = {}
+    for (path, px) in images.items():
+        if px is None:
+            continue
+        (x, y, w, h) = fingerprints.crop_box(px.shape[1], px.shape[0])
+        scaled = fingerprints.reduce_batch(px[np.newaxis, y:y + h, x:x + w])
+        fps[path] = tuple([int(v) for v in np.rint(scaled.reshape(-1))])
+
+    results = [empty_result() for pair in pairs]
+    groups = {}
+    for (i, (src, dst)) in enumerate(pairs):
+        (a, b) = (images[src], images[dst])
+        if a is None or b is None:
+            continue
+        if a.shape != b.shape:
+            print '! image sizes differ', src, dst
+            continue
+        groups.setdefault(a.shape, []).append(i)
+
+    for idx in groups.values():
+        srcs = np.array([images[pairs[i][0]] for i in idx])
+        dsts = np.array([images[pairs[i][1]] for i in idx])
+        mse = mse_batch(srcs, dsts)
+        for (i, v) in zip(idx, mse):
+            (src, dst) = pairs[i]
+            results[i]['3x3'] = rsd(fps[src], fps[dst])
+            results[i]['MSE'] = float(v)
+            results[i]['PSNR'] = psnr(float(v))
+
+    return (results, fps)
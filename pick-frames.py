@@ -2,10 +2,12 @@
 
 import math
 import pickle
-import os
-import re
 import sys
 
+import numpy as np
+
+from frame_index import FrameIndex
+
 def load_day_counts(frames):
     with open(frames, 'r') as f:
         lines = f.readlines()
@@ -17,62 +19,59 @@ def load_day_counts(frames):
         day_count[day] = int(float(count))
     return (days, day_count)
 
-def read_frame_list(path, day):
-    d_path = os.path.join(path, day, 'day')
-    file_re = re.compile(r'\d+-hd.png')
-    raw_files = os.listdir(d_path)
-    files = []
-    for fn in raw_files:
-        if file_re.match(fn):
-            files.append(fn)
-    return sorted(files)
-
-def normalise_set(picks):
-    total = sum([w for (f,w) in picks])
-    return [(f,w/total) for (f,w) in picks]
-
-def pick_day_frames(frames, count):
-    shift = float(len(frames)) / float(count)
+def pick_windows(n, count):
+    # every output frame of a bucket in one pass: the candidate frames
+    # around each window centre p and their normalised weights, a frame
+    # is picked if min(1 / |i - p|, 1) is over the threshold
+    shift = float(n) / float(count)
     mid_point = shift / 2.0
     min_weight = min(1.0 / shift, 1.0)
+    # with one frame or less per window no weight exceeds 1, so halve it
+    if min_weight >= 1.0:
+        min_weight /= 2.0
+    centres = np.cumsum([mid_point] + [shift] * count)
+    centres = centres[centres < n]
+    reach = int(math.ceil(1.0 / min_weight)) + 1
+    frames = np.floor(centres).astype(np.intp)[:, np.newaxis] + np.arange(-reach, reach + 1)
+    d = np.abs(frames - centres[:, np.newaxis])
+    with np.errstate(divide='ignore'):
+        weights = np.where(d == 0.0, 1.0, np.minimum(1.0 / d, 1.0))
+    picked = (frames >= 0) & (frames < n) & (weights > min_weight)
+    weights = np.where(picked, weights, 0.0)
+    weights /= np.sum(weights, axis=1)[:, np.newaxis]
+    return (frames, weights, picked)
+
+def pick_bucket_frames(names, count):
+    (frames, weights, picked) = pick_windows(len(names), count)
     result = []
-    p = mid_point
-    while p < len(frames):
-        weight = []
-        picked = []
-        for i in range(len(frames)):
-            if i != p:
-                weight.append(min(1.0 / abs(i - p), 1.0))
-            else:
-                weight.append(1.0)
-        i_min_weight = min_weight
-        while len(picked) == 0:
-            for i in range(len(frames)):
-                if weight[i] > i_min_weight:
-                    picked.append((frames[i], weight[i]))
-            i_min_weight /= 2.0
-        p += shift
-        result.append(normalise_set(picked))
+    for (f, w, p) in zip(frames, weights, picked):
+        result.append(zip(names[f[p]].tolist(), w[p].tolist()))
     return result
 
 def main(args):
     if len(args) >= 3:
         (path, frames, out_file) = args[0:3]
+        # buckets are days, or hours or minutes for finer easing
         (days, day_count) = load_day_counts(frames)
+        index = FrameIndex()
+        index.open(path, mmap=True)
+        rows = index.select(period='day')
         picked = {}
         result = { 'days': days, 'day_count': day_count, 'picked': picked }
         errors = []
         for day in days:
-            try:
-                src_frames = read_frame_list(path, day)
-                frame_sets = pick_day_frames(src_frames, day_count[day])
-                picked[day] = frame_sets
-                print day, day_count[day]
-                for (i, ls) in zip(range(len(frame_sets)), frame_sets):
-                    for (f,w) in ls:
-                        print "  % d %.5f %s" % (i, w, f)
-            except OSError as e:
+            src_frames = index.bucket_rows(day, rows)
+            if len(src_frames) == 0 or day_count[day] <= 0:
                 errors.append(day)
+                continue
+            frame_sets = pick_bucket_frames(index.frame_names(src_frames), day_count[day])
+            picked[day] = frame_sets
+            print day, day_count[day]
+            for (i, ls) in zip(range(len(frame_sets)), frame_sets):
+                for (f,w) in ls:
+                    print "  % d %.5f %s" % (i, w, f)
+        if errors:
+            print '! no frames picked for', ' '.join(errors)
         with open(out_file, 'wb') as f: 
             data = pickle.dump(result, f)
     else:
@@ -0,0 +1,524 @@
+#!/usr/bin/env python
+
+import os, os.path
+import shutil
+import struct
+import sys
+import tempfile
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+from image_io import QUANTUM_RANGE, decode_image, image_size, load_image, save_image, to_char, to_quantum
+
+N_BINS = 16
+OUTPUTS = ['avg', 'geoavg', 'min', 'max', 'diff']
+
+# rough resident bytes per output pixel of an averaging job
+AVGIMG_BYTES_PER_PIXEL = 232    # pixelstat_t plus input and output wands
+NUMPY_BYTES_PER_PIXEL = 168     # four float64 RGB planes plus a decoded frame
+MERGE_BYTES_PER_PIXEL = 240     # accumulated plus loaded partial
+BINS_BYTES_PER_PIXEL = N_BINS * 3 * 4
+BASE_MB = 16
+# peak memory of an averaging job in MB, larger images are averaged in
+# bands of rows to keep under it (None to always hold the whole image)
+MEMORY_MB = 1024
+# held for the whole image when working in bands: a decoded frame (and
+# PIL's copy of it), plus each 8-bit RGB output
+DECODED_BYTES_PER_PIXEL = 6
+OUTPUT_BYTES_PER_PIXEL = 3
+# fewer rows than this to a band and the limit gives way, each band has
+# its own pass over every source
+MIN_BAND_ROWS = 16
+
+# streaming per-pixel statistics, equivalent to the pixelstat_t
+# accumulators in avgimg.c but held as whole-image arrays
+class PixelStats:
+    def __init__(self, shape, bins=False):
+        (height, width) = shape[0:2]
+        self.shape = (height, width, 3)
+        self.count = 0
+        self.weight_sum = 0.0
+        self.sum = np.zeros(self.shape, dtype=np.float64)
+        self.gsum = np.zeros(self.shape, dtype=np.float64)
+        self.min = np.empty(self.shape, dtype=np.float64)
+        self.min.fill(float(1 << 30))
+        self.max = np.zeros(self.shape, dtype=np.float64)
+        if bins:
+            self.hist = np.zeros((N_BINS,) + self.shape, dtype=np.uint32)
+        else:
+            self.hist = None
+
+    def update(self, px, weight=1.0):
+        if px.shape != self.shape:
+            return False
+        if weight != 1.0:
+            px = px * weight
+        self.count += 1
+        self.weight_sum += weight
+        self.sum += px
+        with np.errstate(divide='ignore'):
+            self.gsum += np.log10(px)
+        np.minimum(self.min, px, out=self.min)
+        np.maximum(self.max, px, out=self.max)
+        if self.hist is not None:
+            b = (px * (N_BINS / (QUANTUM_RANGE + 1.0))).astype(np.intp)
+            np.clip(b, 0, N_BINS - 1, out=b)
+            for i in range(N_BINS):
+                self.hist[i] += (b == i)
+        return True
+
+    def merge(self, other):
+        if other.shape != self.shape:
+            return False
+        self.count += other.count
+        self.weight_sum += other.weight_sum
+        self.sum += other.sum
+        self.gsum += other.gsum
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        if self.hist is not None:
+            if other.hist is None:
+                self.hist = None
+            else:
+                self.hist += other.hist
+        return True
+
+    def divisor(self):
+        # avgimg divides by the weight sum if weights are used
+        if self.weight_sum != self.count:
+            return self.weight_sum
+        else:
+            return float(self.count)
+
+    def average(self):
+        n = self.divisor()
+        if n <= 0.0:
+            return {
+                'avg': self.sum, 'geoavg': self.gsum,
+                'min': self.min, 'max': self.max,
+                'diff': self.max - self.min
+            }
+        return {
+            'avg': self.sum / n,
+            'geoavg': np.power(10.0, self.gsum / n),
+            'min': self.min,
+            'max': self.max,
+            'diff': self.max - self.min
+        }
+
+    def bin(self, i):
+        n = max(float(self.count), 1.0)
+        return (QUANTUM_RANGE * self.hist[i]) / n
+
+def save_stats(path, stats):
+    # min/max are whole quantum values, so float32 holds them exactly; the
+    # sums lose under one part in 10^6, which moves an 8-bit output by one
+    # only where it lies on a rounding boundary. np.savez, not
+    # savez_compressed, so open_npz can read bands in place
+    arrays = {
+        'count': np.array(stats.count),
+        'weight_sum': np.array(stats.weight_sum),
+        'sum': stats.sum.astype(np.float32),
+        'gsum': stats.gsum.astype(np.float32),
+        'min': stats.min.astype(np.float32),
+        'max': stats.max.astype(np.float32)
+    }
+    if stats.hist is not None:
+        arrays['hist'] = stats.hist.astype(np.uint16)
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+# an array stored in C order in a file, read or written a band of rows at a
+# time with plain file I/O so only the band is ever resident; rows are
+# along axis 1 for the histogram, whose first axis is the bin
+class StoredArray:
+    def __init__(self, path, offset, shape, dtype, axis=0):
+        self.path = path
+        self.offset = offset
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.axis = axis
+
+    def row_items(self):
+        return int(np.prod(self.shape[self.axis + 1:]))
+
+    def blocks(self, start):
+        # file offset of row start in each leading block (one bin each)
+        row_bytes = self.row_items() * self.dtype.itemsize
+        block_bytes = self.shape[self.axis] * row_bytes
+        n = int(np.prod(self.shape[:self.axis]))
+        return [self.offset + i * block_bytes + start * row_bytes for i in range(n)]
+
+    def read(self, start, stop):
+        parts = []
+        with open(self.path, 'rb') as f:
+            for offset in self.blocks(start):
+                f.seek(offset)
+                parts.append(np.fromfile(f, dtype=self.dtype, count=(stop - start) * self.row_items()))
+        return np.concatenate(parts).reshape(self.shape[:self.axis] + (stop - start,) + self.shape[self.axis + 1:])
+
+    def write(self, start, stop, data):
+        data = np.ascontiguousarray(data, dtype=self.dtype).reshape(-1, (stop - start) * self.row_items())
+        with open(self.path, 'r+b') as f:
+            for (offset, part) in zip(self.blocks(start), data):
+                f.seek(offset)
+                part.tofile(f)
+
+def read_npy_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+def open_npz(path):
+    # the members of an npz as written by np.savez, which stores them
+    # uncompressed, as StoredArrays (or values, for scalars) read in place
+    arrays = {}
+    with zipfile.ZipFile(path) as zf:
+        infos = zf.infolist()
+    with open(path, 'rb') as f:
+        for info in infos:
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(path)[name]
+                continue
+            # skip the local file header to the start of the .npy data
+            f.seek(info.header_offset)
+            (name_len, extra_len) = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            (shape, fortran, dtype) = read_npy_header(f)
+            if fortran:
+                arrays[name] = np.load(path)[name]
+            elif len(shape) == 0:
+                arrays[name] = np.fromfile(f, dtype=dtype, count=1).reshape(shape)
+            else:
+                arrays[name] = StoredArray(path, f.tell(), shape, dtype, axis=(1 if name == 'hist' else 0))
+    return arrays
+
+# accumulators saved by save_stats or PartialWriter, read a band at a time
+class StoredStats:
+    def __init__(self, path):
+        self.arrays = open_npz(path)
+        self.shape = self.arrays['sum'].shape
+        self.count = int(self.arrays['count'])
+        self.weight_sum = float(self.arrays['weight_sum'])
+        self.hist = self.arrays.get('hist')
+
+    def rows(self, name, start, stop):
+        a = self.arrays[name]
+        if isinstance(a, StoredArray):
+            return a.read(start, stop)
+        if a.ndim == 4:
+            return a[:, start:stop]
+        return a[start:stop]
+
+    def band(self, start, stop):
+        # rows start:stop as an in-memory PixelStats
+        stats = PixelStats((stop - start, self.shape[1]), bins=(self.hist is not None))
+        stats.count = self.count
+        stats.weight_sum = self.weight_sum
+        stats.sum = self.rows('sum', start, stop).astype(np.float64)
+        stats.gsum = self.rows('gsum', start, stop).astype(np.float64)
+        stats.min = self.rows('min', start, stop).astype(np.float64)
+        stats.max = self.rows('max', start, stop).astype(np.float64)
+        if stats.hist is not None:
+            stats.hist = self.rows('hist', start, stop).astype(np.uint32)
+        return stats
+
+# accumulators written a band at a time to .npy files, then stored in an
+# npz with the same members and dtypes as save_stats
+class PartialWriter:
+    def __init__(self, path, shape, bins=False):
+        self.path = path
+        self.tmp = tempfile.mkdtemp(prefix='.partial-', dir=os.path.dirname(os.path.abspath(path)))
+        self.arrays = {}
+        for (name, dtype, array_shape) in [
+                ('sum', np.float32, shape), ('gsum', np.float32, shape),
+                ('min', np.float32, shape), ('max', np.float32, shape)] + (
+                [('hist', np.uint16, (N_BINS,) + shape)] if bins else []):
+            fn = os.path.join(self.tmp, name + '.npy')
+            # a header and room for the data, filled in by write()
+            with open(fn, 'wb') as f:
+                np.lib.format.write_array_header_2_0(f, {
+                    'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                    'fortran_order': False,
+                    'shape': array_shape})
+                offset = f.tell()
+                f.truncate(offset + int(np.prod(array_shape)) * np.dtype(dtype).itemsize)
+            self.arrays[name] = StoredArray(fn, offset, array_shape, dtype, axis=(1 if name == 'hist' else 0))
+
+    def write(self, start, stop, stats):
+        self.arrays['sum'].write(start, stop, stats.sum)
+        self.arrays['gsum'].write(start, stop, stats.gsum)
+        self.arrays['min'].write(start, stop, stats.min)
+        self.arrays['max'].write(start, stop, stats.max)
+        if 'hist' in self.arrays:
+            self.arrays['hist'].write(start, stop, stats.hist)
+
+    def close(self, count, weight_sum):
+        try:
+            np.save(os.path.join(self.tmp, 'count.npy'), np.array(count))
+            np.save(os.path.join(self.tmp, 'weight_sum.npy'), np.array(weight_sum))
+            with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+                for fn in sorted(os.listdir(self.tmp)):
+                    zf.write(os.path.join(self.tmp, fn), fn)
+        finally:
+            shutil.rmtree(self.tmp)
+
+    def abort(self):
+        shutil.rmtree(self.tmp)
+
+def band_rows(width, height, bytes_per_pixel, n_outputs, memory_mb=None, decoded=True):
+    # rows of accumulators that fit in memory_mb, MEMORY_MB if not given,
+    # next to n_outputs whole output images (and a decoded source)
+    if memory_mb is None:
+        memory_mb = MEMORY_MB
+    if memory_mb is None:
+        return height
+    fixed = n_outputs * OUTPUT_BYTES_PER_PIXEL + (DECODED_BYTES_PER_PIXEL if decoded else 0)
+    free = ((memory_mb - BASE_MB) << 20) - width * height * fixed
+    return int(min(height, max(MIN_BAND_ROWS, free // (width * bytes_per_pixel))))
+
+def bands(height, rows):
+    return [(start, min(start + rows, height)) for start in range(0, height, rows)]
+
+def memory_estimate(src, bytes_per_pixel=NUMPY_BYTES_PER_PIXEL):
+    # in MB, from the dimensions of one of the inputs
+    (weight, path) = parse_source(src)
+    (width, height) = image_size(path)
+    return BASE_MB + (width * height * bytes_per_pixel) / (1 << 20)
+
+def banded_estimate(src, bytes_per_pixel=NUMPY_BYTES_PER_PIXEL):
+    # memory_estimate for the numpy averages, which keep to MEMORY_MB
+    estimate = memory_estimate(src, bytes_per_pixel)
+    if MEMORY_MB is not None:
+        return min(estimate, MEMORY_MB)
+    return estimate
+
+def parse_source(src):
+    # sources may be prefixed with a weight, e.g. 0.2:in0.png
+    if ':' in src:
+        (weight, path) = src.split(':', 1)
+        try:
+            return (float(weight), path)
+        except ValueError:
+            pass
+    return (1.0, src)
+
+def accumulate(srcs, stats=None, bins=False):
+    for src in srcs:
+        (weight, path) = parse_source(src)
+        print 'read: %s (weight: %.5f)' % (path, weight)
+        px = load_image(path)
+        if stats is None:
+            stats = PixelStats(px.shape, bins=bins)
+        if not stats.update(px, weight=weight):
+            print '! input dimensions for %s (%dx%d) do not match output dimensions %dx%d; ignoring' % (
+                path, px.shape[1], px.shape[0], stats.shape[1], stats.shape[0])
+    return stats
+
+# decoded sources written to a scratch file on the first band pass and read
+# back a band of rows at a time, so each is decoded once however many bands
+# the image is averaged in
+class SourceRows:
+    def __init__(self, dir):
+        self.tmp = tempfile.mkdtemp(prefix='.rows-', dir=dir)
+        self.frames = {}
+
+    def rows(self, path, start, stop):
+        if path in self.frames:
+            return to_quantum(self.frames[path].read(start, stop))
+        px = decode_image(path)
+        fn = os.path.join(self.tmp, '%d.raw' % len(self.frames))
+        with open(fn, 'wb') as f:
+            px.tofile(f)
+        self.frames[path] = StoredArray(fn, 0, px.shape, px.dtype)
+        return to_quantum(px[start:stop])
+
+    def close(self):
+        shutil.rmtree(self.tmp)
+
+def accumulate_band(srcs, size, start, stop, sources, bins=False):
+    # rows start:stop of every source the same size as the first
+    (width, height) = size
+    stats = PixelStats((stop - start, width), bins=bins)
+    for src in srcs:
+        (weight, path) = parse_source(src)
+        if start == 0:
+            print 'read: %s (weight: %.5f)' % (path, weight)
+        src_size = image_size(path)
+        if src_size != size:
+            if start == 0:
+                print '! input dimensions for %s (%dx%d) do not match output dimensions %dx%d; ignoring' % (
+                    (path,) + src_size + size)
+            continue
+        stats.update(sources.rows(path, start, stop), weight=weight)
+    return stats
+
+def save_outputs(prefix, stats, outputs=OUTPUTS):
+    result = stats.average()
+    for ext in outputs:
+        fn = prefix + '-' + ext + '.png'
+        print 'saving', fn
+        save_image(fn, result[ext])
+    if stats.hist is not None:
+        for i in range(N_BINS):
+            fn = prefix + ('-bin%02d' % i) + '.png'
+            print 'saving', fn
+            save_image(fn, stats.bin(i))
+
+def output_names(bins=False):
+    if bins:
+        return OUTPUTS + ['bin%02d' % i for i in range(N_BINS)]
+    return OUTPUTS
+
+# 8-bit output images filled in a band of rows at a time
+class BandOutputs:
+    def __init__(self, shape, names):
+        self.names = names
+        self.images = dict([(name, np.zeros(shape, dtype=np.uint8)) for name in names])
+
+    def write(self, start, stop, stats):
+        result = stats.average()
+        for name in self.names:
+            if name.startswith('bin'):
+                px = stats.bin(int(name[3:]))
+            else:
+                px = result[name]
+            self.images[name][start:stop] = to_char(px)
+
+    def save(self, prefix):
+        for name in self.names:
+            fn = prefix + '-' + name + '.png'
+            print 'saving', fn
+            Image.fromarray(self.images[name]).save(fn)
+
+def average_bands(prefix, srcs, size, rows, names, bins=False, partial=None):
+    # accumulate rows bands at a time, the sources decoded on the first
+    # pass and spilled next to prefix for the others
+    (width, height) = size
+    outputs = BandOutputs((height, width, 3), names)
+    sources = SourceRows(os.path.dirname(os.path.abspath(prefix)))
+    writer = None
+    if partial:
+        writer = PartialWriter(partial, (height, width, 3), bins=bins)
+    try:
+        for (start, stop) in bands(height, rows):
+            stats = accumulate_band(srcs, size, start, stop, sources, bins=bins)
+            outputs.write(start, stop, stats)
+            if writer:
+                writer.write(start, stop, stats)
+    except:
+        if writer:
+            writer.abort()
+        raise
+    finally:
+        sources.close()
+    if writer:
+        writer.close(stats.count, stats.weight_sum)
+    return outputs
+
+def source_size(src):
+    (weight, path) = parse_source(src)
+    return image_size(path)
+
+def average_images(prefix, srcs, mode=None, bins=False, memory_mb=None):
+    # accumulators for the whole image at once if they fit in memory_mb
+    size = source_size(srcs[0])
+    bytes_per_pixel = NUMPY_BYTES_PER_PIXEL + (BINS_BYTES_PER_PIXEL if bins else 0)
+    if mode:
+        names = [{'-m': 'avg', '-g': 'geoavg'}[mode]]
+    else:
+        names = output_names(bins)
+    rows = band_rows(size[0], size[1], bytes_per_pixel, len(names), memory_mb)
+    if rows < size[1]:
+        outputs = average_bands(prefix, srcs, size, rows, names, bins=bins)
+        if mode:
+            print 'saving', prefix
+            Image.fromarray(outputs.images[names[0]]).save(prefix)
+        else:
+            outputs.save(prefix)
+        return True
+    stats = accumulate(srcs, bins=bins)
+    if mode == '-m':
+        save_image(prefix, stats.average()['avg'])
+    elif mode == '-g':
+        save_image(prefix, stats.average()['geoavg'])
+    else:
+        save_outputs(prefix, stats)
+    return True
+
+def average_partial(prefix, srcs, partial, memory_mb=None):
+    # average and keep the accumulators so larger buckets can be merged
+    size = source_size(srcs[0])
+    rows = band_rows(size[0], size[1], NUMPY_BYTES_PER_PIXEL, len(OUTPUTS), memory_mb)
+    if rows < size[1]:
+        average_bands(prefix, srcs, size, rows, OUTPUTS, partial=partial).save(prefix)
+        return True
+    stats = accumulate(srcs)
+    save_stats(partial, stats)
+    save_outputs(prefix, stats)
+    return True
+
+def merge_partials(prefix, partials, memory_mb=None):
+    # partials are mapped from disk and merged a band of rows at a time
+    parts = []
+    for path in partials:
+        print 'merge:', path
+        part = StoredStats(path)
+        if parts and part.shape != parts[0].shape:
+            print '! partial dimensions for %s do not match; ignoring' % path
+            continue
+        parts.append(part)
+    (height, width) = parts[0].shape[0:2]
+    bins = all([part.hist is not None for part in parts])
+    bytes_per_pixel = MERGE_BYTES_PER_PIXEL + (2 * BINS_BYTES_PER_PIXEL if bins else 0)
+    names = output_names(bins)
+    outputs = BandOutputs((height, width, 3), names)
+    rows = band_rows(width, height, bytes_per_pixel, len(names), memory_mb, decoded=False)
+    for (start, stop) in bands(height, rows):
+        stats = None
+        for part in parts:
+            if stats is None:
+                stats = part.band(start, stop)
+            else:
+                stats.merge(part.band(start, stop))
+        outputs.write(start, stop, stats)
+    outputs.save(prefix)
+    return True
+
+def usage():
+    print 'pixel_stats.py [-b|-g|-m] [-l <MB>] <output> <input0> [<input1> ...]'
+
+def main(args):
+    mode = None
+    bins = False
+    memory_mb = None
+    while len(args) > 0 and args[0].startswith('-'):
+        if args[0] == '-b':
+            bins = True
+        elif args[0] == '-l' and len(args) > 1:
+            # peak memory, accumulators are held in bands of rows to fit
+            memory_mb = int(args[1])
+            args = args[1:]
+        elif args[0] in ['-g', '-m'] and not mode:
+            mode = args[0]
+        elif args[0] == '--':
+            args = args[1:]
+            break
+        else:
+            usage()
+            sys.exit(1)
+        args = args[1:]
+
+    if len(args) >= 2 and not (bins and mode):
+        average_images(args[0], args[1:], mode=mode, bins=bins, memory_mb=memory_mb)
+    else:
+        usage()
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+    sys.exit(0)
@@ -1,62 +1,42 @@
 #!/usr/bin/env python
 
+import io
+import multiprocessing
+import os, os.path
 import pickle
 import sys
 
 import numpy as np
-from scipy.stats.mstats import gmean
 
-import matplotlib
-matplotlib.use('Agg')
+from energy import ENERGIES
+from measure_store import MeasureStore
+import energy
 
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+PLOT_DPI = 300
+# pages rendered in parallel are rasterized at this resolution
+RASTER_DPI = 150
 
-METRICS = ['3x3', 'MSE', 'PSNR']
-SERIES = ['prev', '5day', 'month']
+# matplotlib is only imported when something is plotted
+plt = None
 
-def find_measures(data):
-    return (data.values()[0]).keys()
+def load_matplotlib():
+    global plt
+    if plt is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        matplotlib.rc('xtick', labelsize=8)
+        import matplotlib.pyplot
+        plt = matplotlib.pyplot
 
-def select_values(data, days, measure, metric):
-    ys = {}
-    for s in SERIES:
-        ys[s] = []
-    ys['avg'] = []
-
-    for day in days:
-        for s in SERIES:
-            if (s in data[day][measure]) and data[day][measure][s]:
-                ys[s].append(data[day][measure][s][metric])
-            else:
-                ys[s].append(0.0)
-    
-    for i in range(len(days)):
-        _sum = 0.0
-        for s in SERIES:
-            _sum += ys[s][i]
-        ys['avg'].append(_sum / float(len(SERIES)))
-
-    return ys
-
-def select_tones(data, days, measure):
-    ys = []
-    for day in days:
-        tone = data[day][measure]['tone']
-        ys.append((tone[0] / 65535.0, tone[1] / 65535.0, tone[2] / 65535.0))
-    return ys
+def select_tones(tones, m):
+    return [tuple(tone) for tone in tones[:, m] / 65535.0]
 
 def pick_colour(cmap, n):
     return cmap(n)
 
-def filter_series(ys, picks):
-    result = {}
-    for p in picks:
-        result[p] = ys[p]
-    return result
-
-def plot_values(pages, label, days, ys):
+def plot_values(pages, label, days, ys, format='pdf', dpi=PLOT_DPI):
     print 'plot', label
+    load_matplotlib()
     cmap = plt.cm.Paired
     fig = plt.figure()
     ax = fig.add_subplot(111)
@@ -82,10 +62,12 @@ def plot_values(pages, label, days, ys):
     ax.set_title(label)
     ax.legend(ncol=len(ys.keys()), loc='lower right')
     plt.grid(b=True, which='both', color='0.75', linestyle='-')
-    fig.savefig(pages, format='pdf', dpi=300)
+    fig.savefig(pages, format=format, dpi=dpi)
+    plt.close(fig)
 
-def plot_tones(pages, label, days, ys):
+def plot_tones(pages, label, days, ys, format='pdf', dpi=PLOT_DPI):
     print 'plot', label
+    load_matplotlib()
     fig = plt.figure()
     ax = fig.add_subplot(111)
     xs = range(len(days))
@@ -101,160 +83,108 @@ def plot_tones(pages, label, days, ys):
     ax.set_xticklabels(tick_labels, rotation=90)
     ax.set_title(label)
     #plt.grid(b=True, which='both', color='0.75', linestyle='-')
-    fig.savefig(pages, format='pdf', dpi=300)
-
-def summarise_metric(ys):
-    flat = []
-    for s in SERIES:
-        flat += ys[s]
-    m = gmean(flat)
-    result = [0.0] * (len(flat) / len(SERIES))
-    for s in SERIES:
-        for i in range(len(result)):
-            result[i] += ys[s][i] / m
-    for i in range(len(result)):
-        result[i] /= float(len(SERIES))
-    return result
-
-def summarise_metrics(data, days, measure, metrics=METRICS):
-    values = []
-    lens = []
-    for m in metrics:
-        ys = select_values(data, days, measure, m)
-        summary = summarise_metric(ys)
-        values.append(summary)
-        lens.append(len(summary))
-
-    result = [0.0] * min(lens)
-    for v in values:
-        for i in range(len(result)):
-            result[i] += v[i]
-    for i in range(len(result)):
-        result[i] /= float(len(values))
-
-    return result
-
-def compute_energy(ys):
-    result = []
-    m = np.mean(ys)
-    sd = np.std(ys)
-    e = 0.0
-    for i in range(len(ys)):
-        v = (ys[i] - m) / sd
-        e = v
-        #e = (e * 0.7) + (v * 0.3)
-        if e < 0.0:
-            e = 0.0
-        elif e > 1.0:
-            e = 1.0
-        result.append(e)
-    return result
-
-def compute_energy3(ys):
-    result = []
-    m = np.mean(ys)
-    sd = np.std(ys)
-    e = 0.0
-    for i in range(len(ys)):
-        v = (ys[i] - m) / (1.5 * sd)
-        #if v < 0.5:
-        #    v = 0.0
-        e = (e * 0.7) + (v * 0.3)
-        if e < 0.0:
-            e = 0.0
-        elif e > 1.0:
-            e = 1.0
-        result.append(e)
-    return result
-
-def compute_energy2(ys):
-    result = []
-    m = np.mean(ys)
-    sd = np.std(ys)
-    e = 1.0
-    for i in range(len(ys)):
-        s = 0.0
-        for j in range(1, 30):
-            if (i + j) < len(ys):
-                s += ((ys[i + j] - m) / sd) * (1.0 / j)
-            else:
-                s += 1.0 * (1.0 / j)
-        e = (e * 0.95) + (s * 0.05)
-        if e < 0.0:
-            e = 0.0
-        elif e > 1.0:
-            e = 1.0
-        result.append(e)
-    return result
-
-def compute_energy4(ys):
-    e2 = compute_energy2(ys)
-    e3 = compute_energy3(ys)
-    result = []
-    for i in range(len(e2)):
-        v2 = e2[i] * 0.7
-        v3 = e3[i] * 0.3
-        if v2 >= 0.7:
-            result.append(v2 + v3)
-        else:
-            result.append(v2)
-    return result
-
-def diff_energy(ys):
-    result = []
-    e = 0.5
-    for i in range(len(ys)):
-        v = ys[i]
-        e = (e * 0.9) + (v * 0.1)
-        if e < 0.0:
-            e = 0.0
-        elif e > 1.0:
-            e = 1.0
-        result.append(e)
-    return result
+    fig.savefig(pages, format=format, dpi=dpi)
+    plt.close(fig)
+
+def page_list(measures, days, summary, energies, tones):
+    pages = []
+    for (m, measure) in enumerate(measures):
+        pages.append((plot_values, measure + ' summary', days, {'avg': summary[m]}))
+        for (i, key) in enumerate(ENERGIES):
+            pages.append((plot_values, measure + ' ' + key, days, {'e': energies[m, i]}))
+
+    for (m, measure) in enumerate(measures):
+        pages.append((plot_tones, measure + ' tone', days, select_tones(tones, m)))
+    return pages
+
+def render_png(page):
+    (f, label, days, ys) = page
+    out = io.BytesIO()
+    f(out, label, days, ys, format='png', dpi=RASTER_DPI)
+    return out.getvalue()
+
+def render_pages(pages, jobs):
+    # png data for each page, in order
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            return pool.map(render_png, pages, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [render_png(page) for page in pages]
+
+def write_pdf(pages, path, jobs):
+    if jobs > 1:
+        # merge rasterized pages rendered across processes
+        from PIL import Image
+        images = [Image.open(io.BytesIO(png)).convert('RGB') for png in render_pages(pages, jobs)]
+        images[0].save(path, 'PDF', resolution=RASTER_DPI, save_all=True, append_images=images[1:])
+    else:
+        load_matplotlib()
+        from matplotlib.backends.backend_pdf import PdfPages
+        pdf = PdfPages(path)
+        for (f, label, days, ys) in pages:
+            f(pdf, label, days, ys)
+        pdf.close()
+
+def write_pngs(pages, path, jobs):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for (i, png) in enumerate(render_pages(pages, jobs)):
+        label = pages[i][1].replace(' ', '-')
+        with open(os.path.join(path, '%03d-%s.png' % (i, label)), 'wb') as f:
+            f.write(png)
+
+def parse_jobs(args):
+    # -j <n> renders pages in n processes
+    if '-j' in args:
+        i = args.index('-j')
+        return (args[:i] + args[i + 2:], int(args[i + 1]))
+    return (args, 1)
+
+def parse_pngs(args):
+    # -d writes one png per page into a directory instead of a pdf
+    if '-d' in args:
+        i = args.index('-d')
+        return (args[:i] + args[i + 1:], True)
+    return (args, False)
 
 def main(args):
-    matplotlib.rc('xtick', labelsize=8)
-
+    (args, jobs) = parse_jobs(args)
+    (args, pngs) = parse_pngs(args)
     if len(args) >= 2:
-        (input_file, output_file) = args[0:2]
-        with open(input_file, 'rb') as f:
-            data = pickle.load(f)
-
-        pages = PdfPages(output_file)
-
-        days = sorted(data.keys())
-        measures = find_measures(data)
-        output = { 'days': days, 'measures': measures }
-        for measure in measures:
-            output[measure] = result = {}
-            summary = summarise_metrics(data, days, measure)
-            #, metrics=['3x3', 'MSE'])
-            plot_values(pages, measure + ' summary', days, {'avg': summary})
-            for (i,f) in zip(range(1,5), [compute_energy, compute_energy2, compute_energy3, compute_energy4]):
-                key = 'energy' + str(i)
-                energy = f(summary)
-                result[key] = energy
-                plot_values(pages, measure + ' ' + key, days, {'e': energy})
-
-            #for m in METRICS:
-            #    ys = select_values(data, days, measure, m)
-            #    plot_values(pages, measure + ' ' + m, days, ys)
-            #    for s in SERIES:
-            #        filter_ys = filter_series(ys, [s, 'avg'])
-            #        plot_values(pages, measure + ' ' + m + ' ' + s, days, filter_ys)
-
-        for measure in measures:
-            ys = select_tones(data, days, measure)
-            plot_tones(pages, measure + ' tone', days, ys)
-
-        pages.close()
+        (input_path, plot_path) = args[0:2]
+        store = MeasureStore()
+        store.open(input_path)
+        (days, values, tones, fps) = store.ordered()
+        measures = store.measures
+
+        # all measures at once, [measure, day] and [measure, energy, day]
+        summary = energy.summarise(values)
+        #, metrics=[0, 1])
+        energies = energy.energies(summary)
+
+        # '-' skips plotting, with -d (or an existing directory) each page
+        # is a png, otherwise all go to one pdf
+        if plot_path != '-':
+            pages = page_list(measures, days, summary, energies, tones)
+            if pngs or os.path.isdir(plot_path):
+                write_pngs(pages, plot_path, jobs)
+            else:
+                write_pdf(pages, plot_path, jobs)
+        store.close()
 
         if len(args) >= 3:
             results_file = args[2]
             print 'store data to', results_file
+            # energy is indexed [measure, energy kind, day]
+            output = { 'days': days, 'measures': measures, 'energies': ENERGIES, 'energy': energies }
             with open(results_file, 'wb') as f:
-                data = pickle.dump(output, f)            
+                pickle.dump(output, f)
+    else:
+        print 'plot-measures.py <measure-store> <plot.pdf|-> [energy-file] [-j <jobs>]'
+        print 'plot-measures.py -d <measure-store> <png-dir> [energy-file] [-j <jobs>]'
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -1,22 +1,58 @@
 #!/usr/bin/env python
 
-import astral
 import datetime
 import math
 import os, os.path
 import re
-import pickle
 import subprocess
 import sys
 
 from cmd_queue import CommandQueue
+from fp_store import FingerprintStore
+from frame_index import FrameIndex
+from measure_store import MeasureStore, STORE_NAME
+from solar_periods import SolarTable, CANTERBURY
+from watch_dir import DirectoryWatcher
+import base_images
+import derivatives
+import fingerprints
+import metrics
+import pixel_stats
 cmd_queue = CommandQueue()
 
 AVGIMG = 'avgimg'
-FP_CACHE = {}
-CACHE_PATH = None
+BASE_TYPES = ['ld', 'hd', 'hdn']
+DERIVED_TYPES = ['eq', 'eq-gray', 'gray-eq', 'gray-edges']
+# 'numpy' derives base images from one decode, 'convert' runs ImageMagick
+BASE_ENGINE = 'numpy'
+# 'numpy' averages in-process, 'avgimg' runs the external binary
+AVG_ENGINE = 'numpy'
+# 'numpy' fingerprints in-process, 'convert' runs ImageMagick
+FP_ENGINE = 'numpy'
+# 'numpy' scores differences in-process, 'compare' runs ImageMagick
+METRIC_ENGINE = 'numpy'
+# 'numpy' derives the equalized and gray images of an average from one
+# decode, 'convert' runs ImageMagick for each
+DERIV_ENGINE = 'numpy'
+# per-day accumulators kept alongside each day average
+PARTIAL = 'raw-stats.npz'
+# seconds to wait for more frames once one arrives in watch mode
+WATCH_SETTLE = 5.0
+# chrome trace of the commands run
+TRACE = 'trace.json'
+FP_STORE = FingerprintStore()
+INDEX = FrameIndex()
+MEASURE_STORE = MeasureStore()
+# where the camera is, for dawn/day/dusk/night
+LOCATION = CANTERBURY
+SOLAR = SolarTable()
+MEASURES = ['geoavg-eq', 'min-eq', 'min-gray-eq', 'raw-geoavg', 'min-gray-edges', 'geoavg-gray-edges']
 
 def _fingerprint(path):
+    print 'fingerprint', path
+    return tuple([int(v) for v in fingerprints.fingerprint_batch([path])[0]])
+
+def _convert_fingerprint(path):
     print 'fingerprint', path
     if os.path.exists(path):
         ppm = subprocess.check_output(['convert', path, '-gravity', 'center', '-crop', '80%', '-scale', '3x3!', '-compress', 'none', '-depth', '16', 'ppm:'])
@@ -31,43 +67,49 @@ def _fingerprint(path):
         print '! missing', path
         return tuple([0] * 27)
 
-def cache_invalidate(path):
-    global FP_CACHE
-    if path in FP_CACHE:
-        del FP_CACHE[path]
-
 def fingerprint(path):
-    global FP_CACHE
-    if path not in FP_CACHE:
-        FP_CACHE[path] = _fingerprint(path)    
-    return FP_CACHE[path]
-
-def fp_cache_save(path):
-    global FP_CACHE
-    data = {}
-    for (f, fp) in FP_CACHE.items():
-        if f.startswith(path):
-            k = f[len(path):len(f)]
-            data[k] = fp
-    with open(os.path.join(path, 'fp_cache'), 'wb') as f:
-        pickle.dump(data, f)
-
-def fp_cache_load(path):
-    global FP_CACHE
-    if os.path.exists(os.path.join(path, 'fp_cache')):
-        with open(os.path.join(path, 'fp_cache'), 'rb') as f:
-            data = pickle.load(f)
-        for (k, fp) in FP_CACHE.items():
-            FP_CACHE[os.path.join(path, k)] = fp
+    fp = FP_STORE.get(path)
+    if fp is None:
+        if FP_ENGINE == 'convert':
+            fp = _convert_fingerprint(path)
+        else:
+            fp = _fingerprint(path)
+        FP_STORE.put(path, fp)
+    return fp
+
+def fingerprint_all(paths):
+    missing = []
+    seen = {}
+    for path in paths:
+        if path not in seen and not FP_STORE.contains(path):
+            missing.append(path)
+        seen[path] = True
+    if len(missing) > 0:
+        print 'fingerprint', len(missing), 'images'
+        fps = fingerprints.fingerprint_images(missing, n_threads=cmd_queue.n_threads)
+        for (path, fp) in zip(missing, fps):
+            FP_STORE.put(path, tuple([int(v) for v in fp]))
+
+def close_data(path):
+    FP_STORE.close()
+    INDEX.close()
+    MEASURE_STORE.close()
+    SOLAR.close()
+    cmd_queue.close_journal()
+    if path:
+        cmd_queue.write_trace(os.path.join(path, TRACE))
 
 def error_exit():
-    global CACHE_PATH
-    fp_cache_save(CACHE_PATH)
+    close_data(FP_STORE.root)
     sys.exit(1)
 
+# a command failed, ending the run or, when watching, just the batch
+class BatchFailed(Exception):
+    pass
+
 def flush_cmd_queue():
     if not cmd_queue.run():
-        error_exit()
+        raise BatchFailed('commands failed')
 
 def fp_tone(fp):
     s = [ 0.0, 0.0, 0.0 ]
@@ -110,81 +152,19 @@ def fn_to_date(fn, time_shift=None):
         result = result + time_shift
     return result
 
-def day_period(aloc, date):
-    details = aloc.sun(local=True, date=date)
-    t = date.time()
-    dawn = details['dawn'].time()
-    sunrise = details['sunrise'].time()
-    sunset = details['sunset'].time()
-    dusk = details['dusk'].time()
-    if (t < dawn or t > dusk):
-        return 'night'
-    elif (t < sunrise):
-        return 'dawn'
-    elif (t > sunset):
-        return 'dusk'
-    else:
-        return 'day'
-
-def dt_string(date):
-    return "%04d%02d%02d%02d%02d%02d" % (
-        date.year, date.month, date.day, 
-        date.hour, date.minute, date.second
-    )
-
-def day_string(date):
-    return "%04d%02d%02d" % (date.year, date.month, date.day)
-
-def month_string(date):
-    return "%04d%02d" % (date.year, date.month)
-
-def build_mapping(aloc, src_path, dst_path, files, time_shift=None):
-    mapping = {}
-    average = {}
+def build_index(files, time_shift=None):
+    # add frames not yet in the index, returning their rows
+    shift = int(time_shift.total_seconds()) if time_shift else 0
+    entries = []
     for fn in files:
-        dt      = fn_to_date(fn, time_shift=time_shift)
-        period  = day_period(aloc, dt)
-        day     = day_string(dt)
-        month   = month_string(dt)
-        orig    = os.path.join(src_path, fn)
-        details = {
-            'dt': dt,
-            'period': period,
-            'day': day,
-            'month': month,
-            'orig': orig
-        }
-        mapping[fn] = details
-
-        membership = [
-            os.path.join('day', day, 'all'),
-            os.path.join('day', day, period),
-            os.path.join('month', month, 'all'),
-            os.path.join('month', month, period)
-        ]
-        for i in range(-2,3):
-            if i < 0:
-                other = day_string(dt - datetime.timedelta(-i))
-            else:
-                other = day_string(dt + datetime.timedelta(+i))
-            
-            membership += [
-                os.path.join('5day', other, 'all'),
-                os.path.join('5day', other, period)
-            ]
-
-        for entry in membership:
-            if entry not in average:
-                average[entry] = [details]
-            else:
-                average[entry].append(details)
-    
-    return (mapping, average)
-
-def generate_base_img(dst_path, details, img_type):
-    src = details['orig']
-    dst = os.path.join(dst_path, details[img_type])
-    print 'generate', details[img_type]
+        i = INDEX.find(fn)
+        if i is not None and INDEX.rows['shift'][i] == shift:
+            continue
+        dt = fn_to_date(fn, time_shift=time_shift)
+        entries.append((fn, dt, shift))
+    return INDEX.add(entries, SOLAR.classify)
+
+def generate_base_img(src, dst, img_type):
     if img_type == 'ld':
         #subprocess.call(['convert', src, '-scale', '600', dst])
         cmd_queue.add(dst, [src], ['convert', src, '-scale', '600', dst])
@@ -196,88 +176,128 @@ def generate_base_img(dst_path, details, img_type):
         cmd_queue.add(dst, [src], ['convert', src, '-normalize', '-adaptive-resize', '1920', dst])
     else:
         assert(0)
-    # defer mtime load
-    #details[img_type + '_mtime'] = os.path.getmtime(dst)
-    cache_invalidate(dst)
-
-def preprocess(mapping, dst):
-    to_load = []
-    for (fn, d) in mapping.items():
-        path = os.path.join(d['day'], d['period'])
+
+def generate_base_imgs(src, outputs):
+    # ld, hd and hdn from a single decode of the original
+    cmd_queue.add_call(outputs[0], [src], base_images.derive_base_images, [src] + outputs, outputs=outputs)
+
+def move_base_imgs(moved, dst):
+    # base images of frames that changed period follow them to the new
+    # period directory rather than being left behind and made again
+    for (i, old_period) in moved:
+        path = os.path.join(dst, INDEX.day(i), INDEX.period(i))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for img_type in BASE_TYPES:
+            old = os.path.join(dst, INDEX.day(i), old_period, INDEX.frame_name(i, img_type))
+            if os.path.exists(old):
+                os.rename(old, os.path.join(dst, INDEX.img_path(i, img_type)))
+
+def preprocess(rows, src_path, dst):
+    for i in rows:
+        src = os.path.join(src_path, INDEX.rows['name'][i])
+        path = os.path.join(INDEX.day(i), INDEX.period(i))
         if not os.path.exists(os.path.join(dst, path)):
             os.makedirs(os.path.join(dst, path))
-        for img_type in ['ld', 'hd', 'hdn']:
-            img_path = os.path.join(path, dt_string(d['dt']) + '-' + img_type + '.png')
-            d[img_type] = img_path
-            if not os.path.exists(os.path.join(dst, img_path)):
-                generate_base_img(dst, d, img_type)
-            # defer mtime load
-            to_load.append((d, img_type + '_mtime', os.path.join(dst, img_path)))
+        outputs = [os.path.join(dst, INDEX.img_path(i, t)) for t in BASE_TYPES]
+        if BASE_ENGINE == 'convert':
+            for (img_type, output) in zip(BASE_TYPES, outputs):
+                generate_base_img(src, output, img_type)
+        else:
+            generate_base_imgs(src, outputs)
     
     # flush processing
     flush_cmd_queue()
+    INDEX.save()
 
-    # do deferred mtime loads
-    try:
-        for (d, key, path) in to_load:
-            d[key] = os.path.getmtime(path)
-    except Exception as e:
-        print e
-        error_exit()
+def average_outputs(dst, path, label='raw'):
+    return [os.path.join(dst, path, label + '-' + ext + '.png') for ext in pixel_stats.OUTPUTS]
 
-def generate_average(dst, path, srcs, label='raw'):
+def average_cost(src, bytes_per_pixel, estimate=pixel_stats.memory_estimate):
+    # one cpu slot and memory in proportion to the image size
+    if os.path.exists(src):
+        return (1, estimate(src, bytes_per_pixel))
+    return None
+
+def generate_average(dst, path, srcs, label='raw', partial=None):
     output = os.path.join(dst, path, label)
-    #subprocess.call([AVGIMG, output] + srcs)
-    cmd_queue.add(output, srcs, [AVGIMG, output] + srcs)
-    for ext in ['avg', 'geoavg', 'min', 'max', 'diff']:
-        cache_invalidate(os.path.join(dst, path, label + '-' + ext + '.png'))
+    outputs = average_outputs(dst, path, label=label)
+    if AVG_ENGINE == 'avgimg':
+        cost = average_cost(srcs[0], pixel_stats.AVGIMG_BYTES_PER_PIXEL)
+        #subprocess.call([AVGIMG, output] + srcs)
+        cmd_queue.add(output, srcs, [AVGIMG, output] + srcs, outputs=outputs, cost=cost)
+    elif partial:
+        cost = average_cost(srcs[0], pixel_stats.NUMPY_BYTES_PER_PIXEL, pixel_stats.banded_estimate)
+        cmd_queue.add_call(output, srcs, pixel_stats.average_partial, [output, srcs, partial], outputs=outputs + [partial], cost=cost)
+    else:
+        cost = average_cost(srcs[0], pixel_stats.NUMPY_BYTES_PER_PIXEL, pixel_stats.banded_estimate)
+        cmd_queue.add_call(output, srcs, pixel_stats.average_images, [output, srcs], outputs=outputs, cost=cost)
 
-def build_averages(averages, dst, img_type='ld'):
-    result = {}
-    to_load = []
-    for (path, srcs) in averages.items():
-        path = os.path.join('avg', path)
+def generate_merged_average(dst, path, deps, partials, size_src, label='raw'):
+    output = os.path.join(dst, path, label)
+    outputs = average_outputs(dst, path, label=label)
+    cost = average_cost(size_src, pixel_stats.MERGE_BYTES_PER_PIXEL, pixel_stats.banded_estimate)
+    cmd_queue.add_call(output, deps, pixel_stats.merge_partials, [output, partials], outputs=outputs, cost=cost)
 
-        most_recent = 0
-        for src in srcs:
-            src_mtime = src[img_type + '_mtime']
-            if src_mtime > most_recent:
-                most_recent = src_mtime
+def day_partials(rows, period):
+    return [os.path.join('avg', 'day', day, period) for day in INDEX.days(rows)]
 
-        mtime = 0
+def build_averages(averages, dst, img_type='ld'):
+    result = {}
+    # 5day and month averages are merged from day partials,
+    # so day averages must be queued first
+    use_partials = (AVG_ENGINE != 'avgimg')
+    keys = sorted(averages.keys(), key=lambda k: not k.startswith('day'))
+    for key in keys:
+        rows = averages[key]
+        path = os.path.join('avg', key)
         if not os.path.exists(os.path.join(dst, path)):
             os.makedirs(os.path.join(dst, path))
-        elif os.path.exists(os.path.join(dst, path, 'raw-avg.png')):
-            mtime = os.path.getmtime(os.path.join(dst, path, 'raw-avg.png'))
 
-        if most_recent >= mtime:
-            src_paths = []
-            for src in srcs:
-                src_paths.append(os.path.join(dst, src[img_type]))
-            generate_average(dst, path, src_paths)
-            # defer mtime load
-            #mtime = os.path.getmtime(os.path.join(dst, path, 'raw-avg.png'))
-            to_load.append((path, os.path.join(dst, path, 'raw-avg.png')))
-
-        result[path] = mtime
+        # the build journal skips averages whose sources are unchanged
+        if use_partials and not key.startswith('day'):
+            parts = day_partials(rows, os.path.basename(path))
+            deps = []
+            for p in parts:
+                # day averages not being rebuilt are used as they are
+                if os.path.relpath(p, 'avg') in averages:
+                    deps.append(os.path.join(dst, p, 'raw'))
+                else:
+                    deps.append(os.path.join(dst, p, PARTIAL))
+            part_paths = [os.path.join(dst, p, PARTIAL) for p in parts]
+            generate_merged_average(dst, path, deps, part_paths, os.path.join(dst, INDEX.img_path(rows[0], img_type)))
+        else:
+            src_paths = [os.path.join(dst, INDEX.img_path(i, img_type)) for i in rows]
+            if use_partials:
+                generate_average(dst, path, src_paths, partial=os.path.join(dst, path, PARTIAL))
+            else:
+                generate_average(dst, path, src_paths)
 
     # flush processing
     flush_cmd_queue()
 
     # do deferred mtime loads
     try:
-        for (path, fpath) in to_load:
-            result[path] = os.path.getmtime(fpath)
+        for key in keys:
+            path = os.path.join('avg', key)
+            result[path] = os.path.getmtime(os.path.join(dst, path, 'raw-avg.png'))
     except Exception as e:
-        print e
-        error_exit()
+        raise BatchFailed(str(e))
 
     return result
 
+def generate_derived_imgs(src, outputs):
+    # the four variants from a single decode of the average
+    cost = average_cost(src, derivatives.DERIVE_BYTES_PER_PIXEL)
+    cmd_queue.add_call(outputs[0], [src], derivatives.derive_images, [src] + outputs, outputs=outputs, cost=cost)
+
 def reprocess_averages(averages, dst):
-    for (path, mtime) in averages.items():
+    for path in averages.keys():
         for t in ['geoavg', 'min', 'max']:
             src = os.path.join(dst, path, 'raw-' + t + '.png')
+            if DERIV_ENGINE == 'numpy':
+                generate_derived_imgs(src, [os.path.join(dst, path, t + '-' + d + '.png') for d in DERIVED_TYPES])
+                continue
             gen = {
                 t + "-eq.png": ['-equalize'],
                 t + "-eq-gray.png": ['-equalize', '-separate', '-average'],
@@ -294,11 +314,8 @@ def reprocess_averages(averages, dst):
             }
             for (fn, opts) in gen.items():
                 fpath = os.path.join(dst, path, fn)
-                if (not os.path.exists(fpath)) or (mtime > os.path.getmtime(fpath)):
-                    print 'generate', os.path.join(path, fn)
-                    #subprocess.call(['convert', src] + opts + [fpath])
-                    cmd_queue.add(fpath, [src], ['convert', src] + opts + [fpath])
-                    cache_invalidate(fpath)
+                #subprocess.call(['convert', src] + opts + [fpath])
+                cmd_queue.add(fpath, [src], ['convert', src] + opts + [fpath])
     # flush processing
     flush_cmd_queue()
 
@@ -335,31 +352,59 @@ def difference(src, dst):
 
     return result
 
-def day_list(mapping):
-    days = {}
-    for (fn, d) in mapping.items():
-        days[d['day']] = True
-    return sorted(days.keys())
+def difference_all(pairs):
+    if METRIC_ENGINE == 'compare':
+        result = {}
+        for (src, dst) in pairs:
+            result[(src, dst)] = difference(src, dst)
+        return result
+
+    print 'difference', len(pairs), 'pairs'
+    (results, fps) = metrics.score_pairs(pairs)
+    # keep fingerprints of the decoded images for rsd and tones
+    for (path, fp) in fps.items():
+        if not FP_STORE.contains(path):
+            FP_STORE.put(path, fp)
+    return dict(zip(pairs, results))
+
+def measure_sources(path, day, img_type='geoavg-eq', period='day'):
+    return [
+        os.path.join(path, 'avg', 'day', day, period, img_type + '.png'),
+        os.path.join(path, 'avg', '5day', day, period, img_type + '.png'),
+        os.path.join(path, 'avg', 'month', day[0:6], period, img_type + '.png')
+    ]
+
+def measure_pairs(path, day, prev=None, img_type='geoavg-eq', period='day'):
+    (day_src, _5day_src, month_src) = measure_sources(path, day, img_type=img_type, period=period)
+    pairs = [(_5day_src, day_src), (month_src, day_src)]
+    if prev:
+        prev_src = os.path.join(path, 'avg', 'day', prev, period, img_type + '.png')
+        pairs.append((prev_src, day_src))
+    return pairs
 
-def measure_day(path, day, prev=None, img_type='geoavg-eq', period='day'):
+def measure_day(path, day, prev=None, img_type='geoavg-eq', period='day', diffs=None):
     print 'measure', day, img_type
 
-    day_src = os.path.join(path, 'avg', 'day', day, period, img_type + '.png') 
+    def diff(src, dst):
+        if diffs and (src, dst) in diffs:
+            return diffs[(src, dst)]
+        else:
+            return difference(src, dst)
+
+    (day_src, _5day_src, month_src) = measure_sources(path, day, img_type=img_type, period=period)
     if prev:
         prev_src = os.path.join(path, 'avg', 'day', prev, period, img_type + '.png')
-    _5day_src = os.path.join(path, 'avg', '5day', day, period, img_type + '.png') 
-    month_src = os.path.join(path, 'avg', 'month', day[0:6], period, img_type + '.png')
 
     fp = fingerprint(day_src)
     tone = fp_tone(fp)
 
     if prev:
-        diff_prev = difference(prev_src, day_src)
+        diff_prev = diff(prev_src, day_src)
     else:
         diff_prev = None
     
-    diff_5day = difference(_5day_src, day_src)
-    diff_month = difference(month_src, day_src)
+    diff_5day = diff(_5day_src, day_src)
+    diff_month = diff(month_src, day_src)
 
     return {
         'fp': fp,
@@ -369,9 +414,10 @@ def measure_day(path, day, prev=None, img_type='geoavg-eq', period='day'):
         'month': diff_month
     }
 
-def find_files(path):
+def find_files(path, raw_files=None):
     file_re = re.compile(r'\d{12,14}\.jpg')
-    raw_files = os.listdir(path)
+    if raw_files is None:
+        raw_files = os.listdir(path)
     files = []
     for fn in raw_files:
         fp = os.path.join(path, fn)
@@ -379,11 +425,27 @@ def find_files(path):
             files.append(fn)
     return files
 
-def measure_days(days, dst_path):
+def measure_days(days, dst_path, only=None):
+    # only measure days in only, if given
     data = {}
+    if only is not None:
+        todo = [day for day in days if day in only]
+    else:
+        todo = days
+
+    # fingerprint everything up front in batches,
+    # the in-process metrics fingerprint the images they decode
+    if METRIC_ENGINE == 'compare':
+        paths = []
+        for day in todo:
+            for measure in MEASURES:
+                paths += measure_sources(dst_path, day, img_type=measure)
+        fingerprint_all(paths)
 
     for i in range(len(days)):
         day = days[i]
+        if only is not None and day not in only:
+            continue
         data[day] = day_results = {}
 
         if i > 0:
@@ -391,45 +453,144 @@ def measure_days(days, dst_path):
         else:
             prev_day = None
 
-        for measure in ['geoavg-eq', 'min-eq', 'min-gray-eq', 'raw-geoavg', 'min-gray-edges', 'geoavg-gray-edges']:
-            day_results[measure] = measure_day(dst_path, day, prev=prev_day, img_type=measure)
+        pairs = []
+        for measure in MEASURES:
+            pairs += measure_pairs(dst_path, day, prev=prev_day, img_type=measure)
+        diffs = difference_all(pairs)
+
+        for measure in MEASURES:
+            day_results[measure] = measure_day(dst_path, day, prev=prev_day, img_type=measure, diffs=diffs)
 
     return data
 
-def main(args):
-    global CACHE_PATH
+def save_measures(data):
+    MEASURE_STORE.update(data, INDEX.days())
+
+def prepare_all(src_path, dst_path, files, time_shift=None):
+    INDEX.retain(files)
+    moved = INDEX.reclassify(SOLAR.classify)
+    if moved:
+        print 'day periods changed for', len(moved), 'frames'
+        move_base_imgs(moved, dst_path)
+    build_index(files, time_shift=time_shift)
+    preprocess(range(len(INDEX)), src_path, dst_path)
+    mtimes = build_averages(INDEX.buckets(), dst_path)
+    reprocess_averages(mtimes, dst_path)
+    save_measures(measure_days(INDEX.days(), dst_path))
+
+def affected_days(days, rows):
+    # days whose day, 5day, month or previous day averages changed
+    new_days = {}
+    for i in rows:
+        new_days[INDEX.day(i)] = INDEX.dt(i).date()
+    months = dict([(day[0:6], True) for day in new_days.keys()])
+    result = {}
+    for (i, day) in enumerate(days):
+        date = datetime.datetime.strptime(day, '%Y%m%d').date()
+        if day[0:6] in months:
+            result[day] = True
+        elif i > 0 and days[i - 1] in new_days:
+            result[day] = True
+        else:
+            for other in new_days.values():
+                if abs((date - other).days) <= 2:
+                    result[day] = True
+    return result
 
-    aloc = astral.Astral()['London']
-    # modify for University of Kent, Canterbury
-    aloc.latitude = 51.275
-    aloc.longitude = 1.087
-    aloc.elevation = 72.0
-    
+def prepare_new(src_path, dst_path, files, time_shift=None):
+    # bring outputs up to date for frames added since the last run
+    files = [fn for fn in files if INDEX.find(fn) is None]
+    if len(files) == 0:
+        return
+    print 'ingest', len(files), 'frames'
+    # watch mode runs a batch at a time, keep only this one's commands
+    cmd_queue.reset()
+
+    rows = build_index(files, time_shift=time_shift)
+    preprocess(rows, src_path, dst_path)
+    buckets = INDEX.buckets()
+    affected = dict([(key, buckets[key]) for key in INDEX.buckets(rows).keys()])
+
+    mtimes = build_averages(affected, dst_path)
+    reprocess_averages(mtimes, dst_path)
+    days = INDEX.days()
+    save_measures(measure_days(days, dst_path, only=affected_days(days, rows)))
+
+def watch_batch(src_path, dst_path, files, time_shift=None):
+    # a failed batch is logged and the watch goes on; its frames leave the
+    # index so later batches do not wait on their outputs, and are tried
+    # again by the next full run
+    new = set([fn for fn in files if INDEX.find(fn) is None])
+    try:
+        prepare_new(src_path, dst_path, files, time_shift=time_shift)
+    except BatchFailed as e:
+        print '! batch of %d frames failed (%s), still watching' % (len(new), e)
+        INDEX.retain([name for name in INDEX.rows['name'] if name not in new])
+        INDEX.save()
+
+def watch(src_path, dst_path, time_shift=None):
+    watcher = DirectoryWatcher(src_path)
+    print 'watching', src_path
+    # pick up anything that arrived while the full run was going
+    watch_batch(src_path, dst_path, find_files(src_path), time_shift=time_shift)
+    try:
+        while True:
+            names = watcher.wait()
+            # let a burst of frames arrive together
+            more = watcher.wait(timeout=WATCH_SETTLE)
+            if names is None or more is None:
+                # events were lost, look at everything
+                files = find_files(src_path)
+            else:
+                files = find_files(src_path, raw_files=names + more)
+            watch_batch(src_path, dst_path, files, time_shift=time_shift)
+    except KeyboardInterrupt:
+        print 'stopped watching'
+    watcher.close()
+
+def parse_memory(args):
+    # -l <MB> is the peak memory of an average, larger images are averaged
+    # in bands of rows to keep under it
+    if '-l' in args:
+        i = args.index('-l')
+        return (args[:i] + args[i + 2:], int(args[i + 1]))
+    return (args, None)
+
+def main(args):
     # set a constant time shift from camera data
     time_shift = datetime.timedelta(seconds=-3600)
-    
-    if len(args) == 2:
+
+    (args, memory_mb) = parse_memory(args)
+    if memory_mb is not None:
+        # workers are forked after this
+        pixel_stats.MEMORY_MB = memory_mb
+
+    if len(args) == 2 or (len(args) == 3 and args[2] == 'watch'):
         src_path = args[0]
         dst_path = args[1]
         
-        CACHE_PATH = dst_path
         files = find_files(src_path)
-        fp_cache_load(dst_path)
-        
-        (mapping, averages) = build_mapping(aloc, src_path, dst_path, files, time_shift=time_shift)
-        preprocess(mapping, dst_path)
-        mtimes = build_averages(averages, dst_path)
-        reprocess_averages(mtimes, dst_path)
-        days = day_list(mapping)
-        data = measure_days(days, dst_path)
+        if not os.path.exists(dst_path):
+            os.makedirs(dst_path)
+        FP_STORE.open(dst_path)
+        INDEX.open(dst_path)
+        MEASURE_STORE.open(os.path.join(dst_path, STORE_NAME), MEASURES)
+        SOLAR.open(dst_path, LOCATION)
+        cmd_queue.open_journal(dst_path)
         
-        with open(os.path.join(dst_path, 'measures'), 'wb') as f:
-            pickle.dump(data, f)
+        try:
+            prepare_all(src_path, dst_path, files, time_shift=time_shift)
+        except BatchFailed as e:
+            print '!', e
+            if len(args) == 2:
+                error_exit()
+        if len(args) == 3:
+            watch(src_path, dst_path, time_shift=time_shift)
 
-        fp_cache_save(dst_path)
+        close_data(dst_path)
 
     else:
-        print 'prepare.py <src-path> <dst-path>'
+        print 'prepare.py [-l <average-MB>] <src-path> <dst-path> [watch]'
 
 if __name__ == "__main__":
     main(sys.argv[1:])
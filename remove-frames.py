@@ -1,46 +1,18 @@
 #!/usr/bin/env python
 
-import math
-import pickle
 import sys
 
-from datetime import datetime
+import numpy as np
 
-def usage():
-    print 'remove-frames.py', '[weekend]', '<in>', '<out>'
-
-def is_weekend(ds):
-    dt = datetime(year=int(ds[0:4]), month=int(ds[4:6]), day=int(ds[6:8]))
-    wd = dt.isoweekday()
-    return ((wd == 6) or (wd == 7))
+import frame_alloc
 
-def remove_weekends(days):
-    output = []
-    removed = 0.0
-    for (day, frames) in days:
-        if is_weekend(day):
-            removed += frames
-        else:
-            output.append((day, frames))
-    return (output, removed)
-
-def distribute_spare_frames(days, spare_f):
-    total_f = 0.0
-    for (day, frames) in days:
-        total_f += frames
-    output = []
-    final_f = 0.0
-    for (day, frames) in days:
-        frames += math.floor(((frames / total_f) * spare_f) + 0.5) 
-        output.append((day, frames))
-        final_f += frames
-    print 'moved %d frames to produce %d final (diff %d)' % (spare_f, final_f, final_f - (total_f + spare_f))
-    return output
+def usage():
+    print 'remove-frames.py', '<weekend|filter>', '<in>', '<out>'
 
-def save_frames(fn, days):
+def save_frames(fn, days, frames):
     with open(fn, 'w') as f:
-        for (day, frames) in days:
-            print >>f, day, frames
+        for (day, n) in zip(days, frames):
+            print >>f, day, float(n)
 
 def main(args):
     if len(args) >= 3:
@@ -49,19 +21,28 @@ def main(args):
         out_file = args[2]
 
         days = []
+        frames = []
         with open(in_file, 'r') as f:
             for line in f.readlines():
                 parts = line.split(" ")
-                days.append((parts[0], float(parts[1])))
+                days.append(parts[0])
+                frames.append(float(parts[1]))
 
-        n_days = len(days)
         if op_type == 'weekend':
-            (days, spare_f) = remove_weekends(days)
-            print "removed %d days" % (n_days - len(days))
-            days = distribute_spare_frames(days, spare_f)
-            save_frames(out_file, days)
-        else:
+            op_type = 'weekends'
+        try:
+            keep = frame_alloc.apply_filters([op_type], days)
+        except ValueError as e:
+            print e
             usage()
+            return
+
+        # the frames of removed days are spread over the rest
+        output = frame_alloc.redistribute(frames, keep)
+        spare_f = np.sum(np.array(frames)[~keep])
+        print "removed %d days" % (len(days) - np.count_nonzero(keep))
+        print 'moved %d frames to produce %d final (diff %d)' % (spare_f, np.sum(output), np.sum(output) - sum(frames))
+        save_frames(out_file, [d for (d, k) in zip(days, keep) if k], output[keep])
     else:
         usage()
 
@@ -1,15 +1,29 @@
 #!/usr/bin/env python
 
-import math
 import pickle
 import os
-import re
 import sys
 
+import frame_cache
+import pixel_stats
+import render_engine
+import video_stream
 from cmd_queue import CommandQueue
 cmd_queue = CommandQueue()
 
-def render_frame(src_path, dst_path, day, srcs, n, gn, img_type='hdn'):
+# 'numpy' blends and annotates in-process, 'avgimg' runs avgimg and convert
+RENDER_ENGINE = 'numpy'
+# consecutive frames of a day one worker renders in order, sharing decoded
+# sources through its frame cache; streamed runs are held in memory until
+# the encoder takes them, so each worker has one run of as many frames as
+# it may hold ahead
+RUN_FRAMES = 120
+STREAM_RUN_FRAMES = video_stream.REORDER_FRAMES_PER_WORKER
+# share of each worker's part of the queue memory budget its frame cache
+# may hold, the cache stays with the worker between runs
+CACHE_FRACTION = 0.5
+
+def blend_mode(srcs, img_type):
     # pick mode
     if len(srcs) <= 5:
         weighting = True
@@ -21,15 +35,33 @@ def render_frame(src_path, dst_path, day, srcs, n, gn, img_type='hdn'):
     # always use arithmetic mean for normalised input
     if img_type == 'hdn':
         mode = '-m'
+    return (weighting, mode)
+
+def source_paths(src_path, day, srcs, img_type):
+    # (path, weight) of each source, day may be an hour or minute bucket
+    return [(os.path.join(src_path, day[0:8], 'day', src.replace("-hd.png", "") + '-' + img_type + '.png'), f)
+        for (src, f) in srcs]
+
+def frame_outputs(dst_path, gn, plain):
+    # numbered annotated and plain frames, None where not written
+    if dst_path == '-':
+        return (None, None)
+    ann_gn = os.path.join(dst_path, "frame-annotated-%05d.png" % gn)
+    if plain:
+        return (ann_gn, os.path.join(dst_path, "frame-plain-%05d.png" % gn))
+    return (ann_gn, None)
+
+def render_frame(src_path, dst_path, day, srcs, n, gn, img_type='hdn'):
+    (weighting, mode) = blend_mode(srcs, img_type)
 
     # compile sources and weights
     avg_srcs = []
     for (src, f) in srcs:
         clean = src.replace("-hd.png", "")
         if weighting:
-            avg_srcs.append(("%.4f:" % f) + os.path.join(src_path, day, 'day', clean + '-' + img_type + '.png'))
+            avg_srcs.append(("%.4f:" % f) + os.path.join(src_path, day[0:8], 'day', clean + '-' + img_type + '.png'))
         else:
-            avg_srcs.append(os.path.join(src_path, day, 'day', clean + '-' + img_type + '.png'))
+            avg_srcs.append(os.path.join(src_path, day[0:8], 'day', clean + '-' + img_type + '.png'))
 
     # plain average frame
     avg_dst = os.path.join(dst_path, 'plain-' + day + '-' + ("%03d" % n) + '.png')
@@ -46,14 +78,112 @@ def render_frame(src_path, dst_path, day, srcs, n, gn, img_type='hdn'):
             '-pointsize',   '64',
             '-fill',        '#ffffffa0',
             '-gravity',     'SouthWest', 
-            '-annotate',    '+1570%+20%', day, 
+            '-annotate',    '+1570%+20%', day[0:8], 
             ann_dst ]
     cmd_queue.add(ann_dst, [avg_dst], ann_cmd)
     cmd_queue.add(ann_gn, [ann_dst], ['ln', '-s', ann_dst, ann_gn])
 
+def frame_runs(src_path, dst_path, days, picked, img_type, plain, run_frames=RUN_FRAMES):
+    # arguments of render_engine.render_run, frames of a day in order
+    gn = 0
+    for day in days:
+        run = []
+        for ls in picked.get(day, []):
+            (weighting, mode) = blend_mode(ls, img_type)
+            (ann_gn, plain_gn) = frame_outputs(dst_path, gn, plain)
+            run.append((source_paths(src_path, day, ls, img_type), weighting, mode, day[0:8], ann_gn, plain_gn))
+            gn += 1
+            if len(run) == run_frames:
+                yield run
+                run = []
+        if run:
+            yield run
+
+def queue_run(run):
+    # one call writes the numbered frames of a run directly, the queue runs
+    # it again unless every one of them exists
+    outputs = []
+    deps = []
+    for (paths, weighting, mode, text, ann_gn, plain_gn) in run:
+        outputs += [fn for fn in [ann_gn, plain_gn] if fn]
+        deps += [p for (p, f) in paths if p not in deps]
+    cost = None
+    if os.path.exists(deps[0]):
+        # the worker's cache may be full from earlier runs, so all of it
+        cost = (1, pixel_stats.memory_estimate(deps[0], render_engine.RENDER_BYTES_PER_PIXEL) + (render_engine.CACHE.max_bytes >> 20))
+    cmd_queue.add_call(outputs[0], deps, render_engine.render_run, [run], outputs=outputs, cost=cost)
+
+def render_video(video_path, src_path, dst_path, days, picked, img_type, plain):
+    # frames go straight to the encoder, and to disk unless dst_path is '-'
+    stream = video_stream.VideoStream(video_path)
+    runs = frame_runs(src_path, dst_path, days, picked, img_type, plain, STREAM_RUN_FRAMES)
+    failed = False
+    try:
+        video_stream.stream_frames(stream, render_engine.stream_run, runs, cmd_queue.n_threads)
+    except Exception as e:
+        # an encoder that went away or a run that raised in a worker
+        print '!', e
+        failed = True
+    finally:
+        status = stream.close()
+    print 'streamed %d frames to %s (encoder status %d)' % (stream.frames, video_path, status)
+    if failed or status != 0:
+        return 1
+    return 0
+
+def default_cache_mb():
+    # a share of the queue memory budget per worker, at most CACHE_MB
+    if cmd_queue.memory_mb is None:
+        return frame_cache.CACHE_MB
+    share = int(cmd_queue.memory_mb * CACHE_FRACTION / cmd_queue.n_threads)
+    return min(frame_cache.CACHE_MB, share)
+
+def parse_video(args):
+    # -v <video> pipes frames into ffmpeg or avconv
+    if '-v' in args:
+        i = args.index('-v')
+        return (args[:i] + args[i + 2:], args[i + 1])
+    return (args, None)
+
+def parse_cache(args):
+    # -c <MB> limits the decoded frames each worker keeps
+    if '-c' in args:
+        i = args.index('-c')
+        return (args[:i] + args[i + 2:], int(args[i + 1]))
+    return (args, None)
+
+def parse_engine(args):
+    # -e <engine> picks RENDER_ENGINE, e.g. -e avgimg
+    if '-e' in args:
+        i = args.index('-e')
+        return (args[:i] + args[i + 2:], args[i + 1])
+    return (args, RENDER_ENGINE)
+
+def parse_plain(args):
+    # -p also writes frame-plain-%05d.png, the avgimg engine always does
+    if '-p' in args:
+        i = args.index('-p')
+        return (args[:i] + args[i + 1:], True)
+    return (args, RENDER_ENGINE != 'numpy')
+
 def main(args):
+    global RENDER_ENGINE
+    (args, RENDER_ENGINE) = parse_engine(args)
+    if RENDER_ENGINE not in ['numpy', 'avgimg']:
+        print '! unknown render engine', RENDER_ENGINE
+        return 1
+    (args, plain) = parse_plain(args)
+    (args, video_path) = parse_video(args)
+    (args, cache_mb) = parse_cache(args)
+    if cache_mb is None:
+        cache_mb = default_cache_mb()
+    # workers are forked after this, each with its own cache
+    render_engine.CACHE.set_limit(cache_mb)
     if len(args) >= 3:
         (src_path, in_file, out_path) = args[0:3]
+        if out_path == '-' and not video_path:
+            print '! frames must go to a render dir, a video (-v) or both'
+            return 1
         img_type = 'hdn'
         if len(args) > 3:
             img_type = args[3]
@@ -64,19 +194,28 @@ def main(args):
         days = data['days']
         day_count = data['day_count']
         picked = data['picked']
-        
-        frame_n = 0
-        for day in days:
-            if day in picked:
-                frame_sets = picked[day]
-                for (i, ls) in zip(range(len(frame_sets)), frame_sets):
-                    render_frame(src_path, out_path, day, ls, i, frame_n, img_type=img_type)
-                    frame_n += 1
-
-        cmd_queue.run()
+
+        if video_path:
+            return render_video(video_path, src_path, out_path, days, picked, img_type, plain)
+
+        if RENDER_ENGINE == 'numpy':
+            for run in frame_runs(src_path, out_path, days, picked, img_type, plain):
+                queue_run(run)
+        else:
+            frame_n = 0
+            for day in days:
+                if day in picked:
+                    frame_sets = picked[day]
+                    for (i, ls) in zip(range(len(frame_sets)), frame_sets):
+                        render_frame(src_path, out_path, day, ls, i, frame_n, img_type=img_type)
+                        frame_n += 1
+
+        ok = cmd_queue.run()
+        cmd_queue.write_trace(os.path.join(out_path, 'trace.json'))
+        if not ok:
+            return 1
     else:
-        print 'render-frames.py <src-path> <in-file> <out-path>'
+        print 'render-frames.py [-e numpy|avgimg] [-p] [-c <cache-MB>] [-v <video>] <src-path> <in-file> <out-path|-> [img-type]'
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
-    sys.exit(0)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import os, os.path
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from frame_cache import FrameCache
+from image_io import load_image, to_char
+
+# convert -font Bookman-Light -pointsize 64 -fill '#ffffffa0'
+#   -gravity SouthWest -annotate +1570+20
+FONTS = [
+    '/usr/share/fonts/opentype/urw-base35/URWBookman-Light.otf',
+    '/usr/share/fonts/type1/urw-base35/URWBookman-Light.t1',
+    '/usr/share/fonts/type1/gsfonts/b018012l.pfb',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf'
+]
+POINT_SIZE = 64
+FILL = (255, 255, 255, 0xa0)
+OFFSET = (1570, 20)
+
+# rough resident bytes per output pixel, two float64 RGB planes plus a frame
+RENDER_BYTES_PER_PIXEL = 72
+# incremental log sums are rebuilt after this many updates to bound drift
+RECOMPUTE_EVERY = 32
+
+_font = None
+# decoded sources, kept by each worker process across the runs it renders
+CACHE = FrameCache()
+
+def load_font():
+    global _font
+    if _font is None:
+        for path in FONTS:
+            if os.path.exists(path):
+                _font = ImageFont.truetype(path, POINT_SIZE)
+                break
+        else:
+            _font = ImageFont.load_default()
+    return _font
+
+def blend(srcs, weighting, mode, load=load_image):
+    # as avgimg: -m is the arithmetic mean, -g the geometric mean, weighted
+    # pixels are summed and divided by the total weight
+    total = None
+    weight_sum = 0.0
+    for (path, weight) in srcs:
+        if not weighting:
+            weight = 1.0
+        px = np.asarray(load(path), dtype=np.float64)
+        if total is None:
+            total = np.zeros(px.shape)
+        elif px.shape != total.shape:
+            print '! input dimensions for %s do not match; ignoring' % path
+            continue
+        if weight != 1.0:
+            px = px * weight
+        if mode == '-g':
+            with np.errstate(divide='ignore'):
+                total += np.log10(px)
+        else:
+            total += px
+        weight_sum += weight
+    if mode == '-g':
+        return np.power(10.0, total / weight_sum)
+    return total / weight_sum
+
+def annotate(px, text):
+    # px is 8-bit RGB, the text is drawn part transparent in the lower left
+    img = Image.fromarray(px).convert('RGBA')
+    overlay = Image.new('RGBA', img.size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(overlay)
+    font = load_font()
+    (w, h) = draw.textsize(text, font=font)
+    draw.text((OFFSET[0], img.size[1] - OFFSET[1] - h), text, font=font, fill=FILL)
+    return np.asarray(Image.alpha_composite(img, overlay).convert('RGB'))
+
+# blends the frame sets of a run in order, reading the decoded sources from
+# a cache and, for unweighted sets, keeping a running (log) sum that frames
+# entering and leaving the window are added to and taken from
+class SlidingBlend:
+    def __init__(self, cache):
+        self.load = cache.get
+        self.members = set()
+        self.mode = None
+        self.total = None
+        self.zeros = None
+        self.updates = 0
+
+    def add(self, path, sign):
+        px = self.load(path)
+        if px.shape != self.total.shape:
+            print '! input dimensions for %s do not match; ignoring' % path
+            return
+        if self.mode == '-g':
+            # zeros are counted apart, the geometric mean is 0 while any remain
+            zero = (px == 0)
+            self.zeros += sign * zero
+            self.total += sign * np.log10(np.where(zero, 1.0, px))
+        else:
+            self.total += sign * px.astype(np.float64)
+        if sign > 0:
+            self.members.add(path)
+        else:
+            self.members.discard(path)
+
+    def reset(self, paths):
+        self.total = np.zeros(self.load(paths[0]).shape)
+        self.zeros = np.zeros(self.total.shape, dtype=np.int32)
+        self.members = set()
+        self.updates = 0
+        for path in paths:
+            self.add(path, 1)
+
+    def blend(self, srcs, weighting, mode):
+        paths = [path for (path, weight) in srcs]
+        new = set(paths)
+        if weighting:
+            # small weighted sets are blended directly
+            self.total = None
+            return blend(srcs, weighting, mode, load=self.load)
+        if (self.total is None or mode != self.mode or len(new ^ self.members) >= len(new)
+                or (mode == '-g' and self.updates >= RECOMPUTE_EVERY)):
+            self.mode = mode
+            self.reset(paths)
+        else:
+            for path in self.members - new:
+                self.add(path, -1)
+            for path in paths:
+                if path not in self.members:
+                    self.add(path, 1)
+            self.updates += 1
+        return self.mean()
+
+    def mean(self):
+        n = len(self.members)
+        if self.mode == '-g':
+            px = np.power(10.0, self.total / n)
+            px[self.zeros > 0] = 0.0
+            return px
+        return self.total / n
+
+def save_frame(path, px):
+    # written under a temporary name so a killed render leaves no partial frame
+    (head, tail) = os.path.split(path)
+    tmp = os.path.join(head, '.tmp-' + tail)
+    Image.fromarray(px).save(tmp)
+    os.rename(tmp, path)
+
+def render_pixels(px, text, annotated=None, plain=None):
+    # the annotated frame as 8-bit RGB, each image written once if wanted
+    px = to_char(px)
+    if plain:
+        save_frame(plain, px)
+    px = annotate(px, text)
+    if annotated:
+        save_frame(annotated, px)
+    return px
+
+def render_run(frames):
+    # frames are (srcs, weighting, mode, text, annotated, plain) in order
+    since = CACHE.counters()
+    sliding = SlidingBlend(CACHE)
+    for (srcs, weighting, mode, text, annotated, plain) in frames:
+        render_pixels(sliding.blend(srcs, weighting, mode), text, annotated, plain)
+    print '%s: %d frames, %s' % (frames[0][3], len(frames), CACHE.summary(since))
+    return True
+
+def stream_run(frames):
+    # (width, height) and raw rgb24 bytes of each frame for the encoder
+    since = CACHE.counters()
+    sliding = SlidingBlend(CACHE)
+    result = []
+    for (srcs, weighting, mode, text, annotated, plain) in frames:
+        px = render_pixels(sliding.blend(srcs, weighting, mode), text, annotated, plain)
+        result.append(((px.shape[1], px.shape[0]), px.tobytes()))
+    print '%s: %d frames, %s' % (frames[0][3], len(frames), CACHE.summary(since))
+    return result
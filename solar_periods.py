@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import datetime
+import os, os.path
+
+import astral
+import numpy as np
+
+from frame_index import PERIODS
+
+TABLE_NAME = 'solar_table.npz'
+EVENTS = ['dawn', 'sunrise', 'sunset', 'dusk']
+EPOCH_DAYNO = datetime.date(1970, 1, 1).toordinal()
+
+# University of Kent, Canterbury, on London time
+CANTERBURY = {
+    'city': 'London',
+    'latitude': 51.275,
+    'longitude': 1.087,
+    'elevation': 72.0
+}
+
+def make_location(location):
+    aloc = astral.Astral()[location['city']]
+    aloc.latitude = location['latitude']
+    aloc.longitude = location['longitude']
+    aloc.elevation = location['elevation']
+    return aloc
+
+def seconds_of_day(t):
+    return t.hour * 3600 + t.minute * 60 + t.second + t.microsecond / 1e6
+
+def day_events(aloc, dayno):
+    # local dawn, sunrise, sunset and dusk as seconds after midnight
+    sun = aloc.sun(local=True, date=datetime.date.fromordinal(int(dayno)))
+    return [seconds_of_day(sun[e].time()) for e in EVENTS]
+
+# per-day table of solar event times for one location, kept on disk
+# so frames are classified without calling astral for each of them
+class SolarTable:
+    def __init__(self, location=CANTERBURY):
+        self.location = location
+        self.aloc = None
+        self.root = None
+        self.daynos = np.zeros(0, dtype=np.int32)
+        self.events = np.zeros((0, len(EVENTS)))
+        self.dirty = False
+
+    def path(self):
+        return os.path.join(self.root, TABLE_NAME)
+
+    def location_key(self):
+        return (np.array([self.location['city']]), np.array([
+            self.location['latitude'], self.location['longitude'], self.location['elevation']]))
+
+    def open(self, root, location=None):
+        if location is not None:
+            self.location = location
+        self.root = root
+        self.aloc = None
+        self.daynos = np.zeros(0, dtype=np.int32)
+        self.events = np.zeros((0, len(EVENTS)))
+        self.dirty = False
+        if os.path.exists(self.path()):
+            table = np.load(self.path())
+            (city, coords) = self.location_key()
+            if np.array_equal(table['city'], city) and np.array_equal(table['coords'], coords):
+                self.daynos = table['daynos']
+                self.events = table['events']
+            else:
+                print '! location changed, rebuilding solar table'
+
+    def save(self):
+        if self.root is None or not self.dirty:
+            return
+        (city, coords) = self.location_key()
+        tmp = self.path() + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, city=city, coords=coords, daynos=self.daynos, events=self.events)
+        os.rename(tmp, self.path())
+        self.dirty = False
+
+    def close(self):
+        self.save()
+        self.root = None
+
+    def lookup(self, daynos):
+        # event times for each of daynos, adding any days not yet known
+        days = np.unique(daynos)
+        missing = days[np.in1d(days, self.daynos, invert=True)]
+        if len(missing) > 0:
+            if self.aloc is None:
+                self.aloc = make_location(self.location)
+            events = np.array([day_events(self.aloc, d) for d in missing])
+            known = np.concatenate([self.daynos, missing.astype(np.int32)])
+            order = np.argsort(known)
+            self.daynos = known[order]
+            self.events = np.concatenate([self.events, events])[order]
+            self.dirty = True
+        return self.events[np.searchsorted(self.daynos, daynos)]
+
+    def classify(self, ts, daynos):
+        # period codes for naive local timestamps, see frame_index.PERIODS
+        ts = np.asarray(ts)
+        daynos = np.asarray(daynos)
+        periods = np.empty(len(ts), dtype=np.int8)
+        if len(ts) == 0:
+            return periods
+        t = ts - (daynos.astype(np.int64) - EPOCH_DAYNO) * 86400
+        (dawn, sunrise, sunset, dusk) = self.lookup(daynos).T
+        periods[:] = PERIODS.index('day')
+        periods[t > sunset] = PERIODS.index('dusk')
+        periods[t < sunrise] = PERIODS.index('dawn')
+        periods[(t < dawn) | (t > dusk)] = PERIODS.index('night')
+        return periods
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import json
+import os.path
+
+import numpy as np
+
+def command_type(cmd):
+    if isinstance(cmd, tuple):
+        return cmd[0].__name__
+    return os.path.basename(cmd[0])
+
+# timings and resource use of every command a CommandQueue runs
+class TaskTrace:
+    def __init__(self):
+        self.tasks = []
+        self.slots = []
+
+    def take_slot(self):
+        # lowest free worker slot, for the timeline view
+        for (i, used) in enumerate(self.slots):
+            if not used:
+                self.slots[i] = True
+                return i
+        self.slots.append(True)
+        return len(self.slots) - 1
+
+    def release_slot(self, slot):
+        self.slots[slot] = False
+
+    def record(self, fn, cmd, slot, queued, start, end, returncode, usage):
+        (utime, stime, maxrss) = usage
+        self.tasks.append({
+            'fn': fn,
+            'slot': slot,
+            'type': command_type(cmd),
+            'queued': queued,
+            'start': start,
+            'end': end,
+            'returncode': returncode,
+            'utime': utime,
+            'stime': stime,
+            'maxrss_kb': maxrss
+        })
+
+    def chrome_events(self):
+        if len(self.tasks) == 0:
+            return []
+        t0 = min([t['queued'] for t in self.tasks])
+        events = []
+        for t in self.tasks:
+            events.append({
+                'name': t['type'],
+                'cat': 'task',
+                'ph': 'X',
+                'pid': 1,
+                'tid': t['slot'],
+                'ts': int((t['start'] - t0) * 1e6),
+                'dur': int((t['end'] - t['start']) * 1e6),
+                'args': {
+                    'fn': t['fn'],
+                    'returncode': t['returncode'],
+                    'wait_s': t['start'] - t['queued'],
+                    'cpu_s': t['utime'] + t['stime'],
+                    'maxrss_kb': t['maxrss_kb']
+                }
+            })
+        return events
+
+    def write_chrome(self, path):
+        # load in chrome://tracing or Perfetto
+        with open(path, 'w') as f:
+            json.dump({ 'traceEvents': self.chrome_events(), 'displayTimeUnit': 'ms' }, f)
+
+    def summary(self):
+        types = {}
+        for t in self.tasks:
+            types.setdefault(t['type'], []).append(t)
+        result = {}
+        for (name, tasks) in types.items():
+            durations = np.array([t['end'] - t['start'] for t in tasks])
+            result[name] = {
+                'count': len(tasks),
+                'total': float(np.sum(durations)),
+                'p50': float(np.percentile(durations, 50)),
+                'p95': float(np.percentile(durations, 95)),
+                'cpu': sum([t['utime'] + t['stime'] for t in tasks]),
+                'maxrss_kb': max([t['maxrss_kb'] for t in tasks])
+            }
+        return result
+
+    def print_summary(self):
+        summary = self.summary()
+        print '%-16s %8s %10s %8s %8s %10s %10s' % ('command', 'count', 'total', 'p50', 'p95', 'cpu', 'maxrss')
+        for name in sorted(summary.keys(), key=lambda k: -summary[k]['total']):
+            s = summary[name]
+            print '%-16s %8d %10.1f %8.2f %8.2f %10.1f %10d' % (
+                name, s['count'], s['total'], s['p50'], s['p95'], s['cpu'], s['maxrss_kb'])
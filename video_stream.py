@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import collections
+import distutils.spawn
+import multiprocessing
+import subprocess
+
+# the first of these found on the path encodes the video
+ENCODERS = ['ffmpeg', 'avconv']
+FRAME_RATE = 24
+# as the quick video in the README
+ENCODER_ARGS = ['-vb', '12000k']
+# frames rendered or held ahead of the one the encoder needs next, per worker
+REORDER_FRAMES_PER_WORKER = 2
+
+def find_encoder():
+    for name in ENCODERS:
+        path = distutils.spawn.find_executable(name)
+        if path:
+            return path
+    return None
+
+# raw rgb24 frames written to the stdin of an ffmpeg or avconv process
+class VideoStream:
+    def __init__(self, path, rate=FRAME_RATE, args=ENCODER_ARGS):
+        self.path = path
+        self.rate = rate
+        self.args = args
+        self.proc = None
+        self.size = None
+        self.frames = 0
+
+    def open(self, size):
+        encoder = find_encoder()
+        if encoder is None:
+            raise IOError('no video encoder found, tried ' + ', '.join(ENCODERS))
+        self.size = size
+        cmd = [encoder, '-y',
+            '-f',       'rawvideo',
+            '-pix_fmt', 'rgb24',
+            '-s',       '%dx%d' % size,
+            '-r',       str(self.rate),
+            '-i',       '-'] + self.args + [self.path]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, size, data):
+        # size is (width, height), data the rows of rgb bytes
+        if self.proc is None:
+            self.open(size)
+        elif size != self.size:
+            raise IOError('frame %d is %dx%d, the video is %dx%d' % ((self.frames,) + size + self.size))
+        self.proc.stdin.write(data)
+        self.frames += 1
+
+    def close(self):
+        # returns the encoder exit status, 0 if nothing was written
+        if self.proc is None:
+            return 0
+        self.proc.stdin.close()
+        status = self.proc.wait()
+        self.proc = None
+        return status
+
+def stream_frames(stream, func, jobs, n_workers=multiprocessing.cpu_count()):
+    # func(job) returns (size, data) for each frame of a run, a job being a
+    # list of frames; runs are rendered in a pool but written in job order,
+    # with at most REORDER_FRAMES_PER_WORKER frames per worker in flight
+    limit = max(1, n_workers * REORDER_FRAMES_PER_WORKER)
+    pool = multiprocessing.Pool(n_workers)
+    pending = collections.deque()
+    frames = 0
+    try:
+        for job in jobs:
+            # always room for one run, however long
+            while pending and frames + len(job) > limit:
+                (n, result) = pending.popleft()
+                frames -= n
+                for frame in result.get():
+                    stream.write(*frame)
+            pending.append((len(job), pool.apply_async(func, (job,))))
+            frames += len(job)
+        while pending:
+            (n, result) = pending.popleft()
+            for frame in result.get():
+                stream.write(*frame)
+    finally:
+        pool.terminate()
+        pool.join()
+    return stream.frames
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import ctypes
+import ctypes.util
+import os, os.path
+import select
+import struct
+import time
+
+POLL_INTERVAL = 10.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+EVENT_HEADER = struct.Struct('iIII')
+
+def _inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            return None
+        return libc
+    except OSError:
+        return None
+
+# reports files that have been completely written to a directory,
+# using inotify where available and polling otherwise
+class DirectoryWatcher:
+    def __init__(self, path, interval=POLL_INTERVAL, use_inotify=True):
+        self.path = path
+        self.interval = interval
+        self.fd = None
+        libc = _inotify() if use_inotify else None
+        if libc:
+            fd = libc.inotify_init()
+            if fd >= 0 and libc.inotify_add_watch(fd, path, IN_CLOSE_WRITE | IN_MOVED_TO) >= 0:
+                self.fd = fd
+            elif fd >= 0:
+                os.close(fd)
+        # polling state: name -> (size, mtime) when last seen
+        self.seen = {}
+        self.pending = {}
+        if self.fd is None:
+            for fn in os.listdir(path):
+                self.seen[fn] = True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait(self, timeout=None):
+        # names of new files, or None if some may have been missed and the
+        # whole directory should be rescanned
+        if self.fd is not None:
+            return self.wait_inotify(timeout)
+        else:
+            return self.wait_poll(timeout)
+
+    def wait_inotify(self, timeout):
+        (r, w, x) = select.select([self.fd], [], [], timeout)
+        if not r:
+            return []
+        data = os.read(self.fd, 65536)
+        names = []
+        offset = 0
+        overflow = False
+        while offset < len(data):
+            (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if name and name not in names:
+                names.append(name)
+        if overflow:
+            return None
+        return names
+
+    def wait_poll(self, timeout):
+        # a file is reported once its size and mtime stop changing
+        end = None
+        if timeout is not None:
+            end = time.time() + timeout
+        while True:
+            names = []
+            listing = os.listdir(self.path)
+            # forget files that have gone
+            present = set(listing)
+            for fn in [fn for fn in self.seen if fn not in present]:
+                del self.seen[fn]
+            for fn in [fn for fn in self.pending if fn not in present]:
+                del self.pending[fn]
+            for fn in listing:
+                if fn in self.seen:
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.path, fn))
+                except OSError:
+                    continue
+                key = (st.st_size, st.st_mtime)
+                if self.pending.get(fn) == key:
+                    del self.pending[fn]
+                    self.seen[fn] = True
+                    names.append(fn)
+                else:
+                    self.pending[fn] = key
+            if names:
+                return names
+            if end is not None and time.time() >= end:
+                return []
+            delay = self.interval
+            if end is not None:
+                delay = min(delay, max(0.0, end - time.time()))
+            time.sleep(delay)